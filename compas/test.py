@@ -1,14 +1,70 @@
-import requests
-from fake_useragent import UserAgent
-import xml.etree.ElementTree as ET
+from lxml import etree as ET
 import json
+import logging
+import os
+import random
+import time
+import traceback
 import uuid
 import asyncio
+import atexit
+import contextlib
+import hashlib
+import io
+import itertools
+import multiprocessing
+import queue
+import threading
 import httpx
 import re
 from schema import DbDTO, AgentData
-from datetime import date, datetime
-from typing import Optional
+from concurrent.futures import Executor, ProcessPoolExecutor
+from datetime import date
+from functools import lru_cache
+from typing import AsyncIterator, Awaitable, Iterable, Iterator, Optional
+
+try:
+    from fake_useragent import UserAgent
+except ImportError:  # fake-useragent не установлен - берем User-Agent из статического списка
+    UserAgent = None
+
+try:
+    import orjson
+except ImportError:  # orjson не установлен - работаем на стандартном json
+    orjson = None
+
+# Быстрый парсер JSON для больших ответов (orjson принимает и str, и bytes).
+# orjson.JSONDecodeError наследуется от json.JSONDecodeError, так что обработка ошибок общая
+_json_loads = orjson.loads if orjson is not None else json.loads
+
+try:
+    import uvloop
+except ImportError:  # uvloop нет (например, на Windows) - остается стандартный event loop
+    uvloop = None
+else:
+    # asyncio.run() в обертках ниже будет создавать event loop на libuv
+    asyncio.set_event_loop_policy(uvloop.EventLoopPolicy())
+
+
+def _json_dumps(obj) -> bytes:
+    """Сериализует объект в UTF-8 JSON с отступом 2 (orjson, если установлен)"""
+    if orjson is not None:
+        return orjson.dumps(obj, option=orjson.OPT_INDENT_2)
+    return json.dumps(obj, ensure_ascii=False, indent=2).encode('utf-8')
+
+
+def _json_line(obj) -> bytes:
+    """Сериализует объект в одну строку JSONL (с переводом строки в конце)"""
+    if orjson is not None:
+        return orjson.dumps(obj) + b'\n'
+    return json.dumps(obj, ensure_ascii=False).encode('utf-8') + b'\n'
+
+# Настройка логирования
+logging.basicConfig(
+    level=logging.INFO,
+    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s'
+)
+logger = logging.getLogger(__name__)
 
 # Константы для URL
 BASE_URL = 'https://www.compass.com'
@@ -22,146 +78,482 @@ sitemaps = [
 # Парсинг всех sitemap index
 namespace = {'ns': 'http://www.sitemaps.org/schemas/sitemap/0.9'}
 
+# Статические заголовки для страниц объявлений - задаются один раз на клиенте,
+# в каждый запрос передается только User-Agent
+LISTING_HEADERS = {
+    'Accept': 'text/html,application/xhtml+xml,application/xml;q=0.9,*/*;q=0.8',
+    'Accept-Language': 'en-US,en;q=0.5',
+}
+
+# Сколько раз транспорт httpx повторяет неудачную установку соединения (ConnectError/ConnectTimeout)
+# до того, как ошибка дойдет до логики повторов в коде
+_CONNECT_RETRIES = 3
+
+# Координаты области карты в URL локации: mapview=<ne_lat>,<ne_lng>,<sw_lat>,<sw_lng>
+_MAPVIEW_RE = re.compile(r'mapview=([\d.-]+),([\d.-]+),([\d.-]+),([\d.-]+)')
+
+# Расширение файла брошюры среди media объявления. Сравнивается с последними
+# len(_PDF_SUFFIX) символами URL, чтобы не приводить к нижнему регистру всю строку
+_PDF_SUFFIX = '.pdf'
+
+# Начало шаблонного текста формы запроса, который compass отдает вместо описания
+_INQUIRY_PREFIX = 'I would like more information about'
+
+# Ключи полей с площадью, которые встречаются в listingDetails у compass
+_SQFT_KEYS = frozenset({'sqft', 'sq ft', 'sq_ft', 'squarefeet', 'square_feet', 'square feet'})
+
+# Поля AgentData, которые копируются из fullContacts без обработки: (поле AgentData, ключ compass)
+_AGENT_FIELDS = (
+    ('name', 'contactName'),
+    ('license', 'licenseNum'),
+    ('phone_primary', 'phone'),
+    ('office_name', 'company'),
+)
+
+# Актуальные User-Agent'ы десктопных браузеров на случай, если fake-useragent не установлен
+_FALLBACK_USER_AGENTS = (
+    'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/124.0.0.0 Safari/537.36',
+    'Mozilla/5.0 (Macintosh; Intel Mac OS X 10_15_7) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/124.0.0.0 Safari/537.36',
+    'Mozilla/5.0 (X11; Linux x86_64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/124.0.0.0 Safari/537.36',
+    'Mozilla/5.0 (Windows NT 10.0; Win64; x64; rv:125.0) Gecko/20100101 Firefox/125.0',
+    'Mozilla/5.0 (Macintosh; Intel Mac OS X 14.4; rv:125.0) Gecko/20100101 Firefox/125.0',
+    'Mozilla/5.0 (Macintosh; Intel Mac OS X 10_15_7) AppleWebKit/605.1.15 (KHTML, like Gecko) Version/17.4 Safari/605.1.15',
+    'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/124.0.0.0 Safari/537.36 Edg/124.0.0.0',
+)
+
+# UserAgent() при создании загружает базу User-Agent'ов, поэтому создаем его один раз
+# и заранее выбираем пул строк, из которого дальше берем случайную без обращения к базе
+if UserAgent is not None:
+    _UA = UserAgent()
+    _UA_POOL = tuple(dict.fromkeys(_UA.random for _ in range(64)))
+else:
+    _UA_POOL = _FALLBACK_USER_AGENTS
+
+# Пул перемешивается один раз и обходится по кругу; начальные заголовки тоже берут
+# User-Agent из этого цикла, а update_user_agent_in_headers пропускает совпадающую строку,
+# поэтому замена после 403 отличается от предыдущей, если в пуле больше одной строки
+_UA_CYCLE = itertools.cycle(random.sample(_UA_POOL, len(_UA_POOL)))
+
 
 def get_new_user_agent() -> str:
-    """Генерирует новый случайный User-Agent"""
-    return UserAgent().random
+    """Возвращает следующий User-Agent из заранее подготовленного пула"""
+    return next(_UA_CYCLE)
 
 
 def update_user_agent_in_headers(headers: dict) -> dict:
     """Обновляет User-Agent в заголовках"""
     headers = headers.copy()
-    headers['User-Agent'] = get_new_user_agent()
+    new_ua = get_new_user_agent()
+    # Цикл общий для всех задач, поэтому следующая строка может совпасть с текущей
+    if len(_UA_POOL) > 1 and new_ua == headers.get('User-Agent'):
+        new_ua = get_new_user_agent()
+    headers['User-Agent'] = new_ua
     return headers
 
 
-def process_sitemaps_generator(headers: dict = None):
+# Сколько URL из sitemap может ждать потребителя в process_sitemaps_async
+_SITEMAP_QUEUE_SIZE = 10_000
+
+# Параметры iterparse для sitemap: huge_tree снимает ограничения libxml2 на размер
+# документа и узлов текста, recover продолжает разбор после битых фрагментов XML
+_SITEMAP_PARSE_OPTIONS = {'huge_tree': True, 'recover': True}
+
+_SITEMAP_URL_TAG = f"{{{namespace['ns']}}}url"
+_SITEMAP_LOC_TAG = f"{{{namespace['ns']}}}loc"
+_SITEMAP_TAG = f"{{{namespace['ns']}}}sitemap"
+_SITEMAP_LASTMOD_TAG = f"{{{namespace['ns']}}}lastmod"
+
+
+def _iter_sitemap_index(source) -> Iterator[dict]:
+    """
+    Потоково разбирает индекс sitemap (iterparse) и отдает {'url': <loc>, 'lastmod': <lastmod>}
+    для каждого <sitemap>. Обработанные узлы очищаются и удаляются из корня,
+    так что в памяти не копится дерево целиком
+    """
+    for _, sitemap_elem in ET.iterparse(source, events=('end',), tag=_SITEMAP_TAG, **_SITEMAP_PARSE_OPTIONS):
+        loc = sitemap_elem.find(_SITEMAP_LOC_TAG)
+        if loc is not None:
+            lastmod = sitemap_elem.find(_SITEMAP_LASTMOD_TAG)
+            yield {
+                'url': loc.text,
+                'lastmod': lastmod.text if lastmod is not None else None
+            }
+        sitemap_elem.clear()
+        while sitemap_elem.getprevious() is not None:
+            del sitemap_elem.getparent()[0]
+
+
+async def _fetch_sitemap_async(
+    client: httpx.AsyncClient,
+    url: str,
+    headers: dict,
+    stream: bool = False
+) -> tuple[httpx.Response, dict]:
+    """
+    Загружает sitemap с retry при 403 (каждый раз с новым User-Agent).
+    При stream=True тело успешного ответа не читается заранее - вызывающий
+    читает его потоком и закрывает ответ (aclose)
+    
+    Returns:
+        tuple: (последний ответ, актуальные заголовки для следующих запросов)
+    """
+    max_retries = 3
+    response = None
+    for attempt in range(max_retries):
+        response = await client.send(client.build_request('GET', url, headers=headers), stream=stream)
+        if response.status_code == 200:
+            break
+        if stream:
+            # Тело неуспешного ответа не нужно - освобождаем соединение
+            await response.aclose()
+        if response.status_code == 403:
+            if attempt < max_retries - 1:
+                print(f"  403 ошибка, попытка {attempt + 1}/{max_retries}: заменяем User-Agent...")
+                headers = update_user_agent_in_headers(headers)
+            else:
+                print(f"  403 ошибка после {max_retries} попыток")
+        else:
+            break
+    return response, headers
+
+
+async def _aiter_sitemap_locs(response: httpx.Response) -> AsyncIterator[str]:
+    """
+    Разбирает sitemap со списком URL по мере получения тела ответа (XMLPullParser)
+    и отдает содержимое <loc>. Дерево целиком не строится: каждый обработанный <url>
+    очищается и удаляется из корня, так что в памяти не копятся десятки тысяч узлов
+    """
+    parser = ET.XMLPullParser(events=('end',), tag=_SITEMAP_URL_TAG, **_SITEMAP_PARSE_OPTIONS)
+    chunks = response.aiter_bytes()
+    while True:
+        chunk = await anext(chunks, None)
+        if chunk is None:
+            parser.close()
+        else:
+            parser.feed(chunk)
+        for _, url_elem in parser.read_events():
+            loc = url_elem.find(_SITEMAP_LOC_TAG)
+            if loc is not None:
+                yield loc.text
+            url_elem.clear()
+            while url_elem.getprevious() is not None:
+                del url_elem.getparent()[0]
+        if chunk is None:
+            return
+
+
+async def process_sitemaps_async(headers: dict = None, concurrency: int = 10) -> AsyncIterator[str]:
     """
-    Генератор, который постепенно обрабатывает все sitemap файлы и возвращает URL по мере их получения.
-    Это позволяет обрабатывать данные потоково, не накапливая все URL в памяти.
+    Постепенно обрабатывает все sitemap файлы и отдает URL по мере их получения: дочерние sitemap каждого индекса
+    загружаются параллельно (не более concurrency одновременно) через один AsyncClient
+    и разбираются потоково по мере получения тела, а найденные URL передаются потребителю
+    через ограниченную очередь: если потребитель не успевает, загрузка приостанавливается.
+    Порядок URL между разными дочерними sitemap не сохраняется.
+    
+    Args:
+        headers: Заголовки запросов (по умолчанию - случайный User-Agent)
+        concurrency: Количество одновременно загружаемых sitemap файлов
     
     Yields:
         str: URL страницы из sitemap
     """
     if headers is None:
         headers = {
-            'User-Agent': UserAgent().random,
+            'User-Agent': get_new_user_agent(),
         }
     
     total_urls_count = 0
     
-    for sitemap_url in sitemaps:
-        print(f"\n{'='*60}")
-        print(f"Обработка sitemap: {sitemap_url}")
-        print(f"{'='*60}")
-        
-        # Пытаемся получить sitemap с retry при 403
-        max_retries = 3
-        response = None
-        for attempt in range(max_retries):
-            response = requests.get(sitemap_url, headers=headers)
-            if response.status_code == 200:
-                break
-            elif response.status_code == 403:
-                if attempt < max_retries - 1:
-                    print(f"  403 ошибка, попытка {attempt + 1}/{max_retries}: заменяем User-Agent...")
-                    headers = update_user_agent_in_headers(headers)
-                else:
-                    print(f"  403 ошибка после {max_retries} попыток")
-            else:
-                break
-        
-        if response and response.status_code == 200:
-            # Парсим XML
-            root = ET.fromstring(response.content)
+    limits = httpx.Limits(max_connections=concurrency, max_keepalive_connections=concurrency)
+    transport = httpx.AsyncHTTPTransport(http2=True, limits=limits, retries=_CONNECT_RETRIES)
+    async with httpx.AsyncClient(transport=transport, timeout=30.0, follow_redirects=True) as client:
+        for sitemap_url in sitemaps:
+            print(f"\n{'='*60}")
+            print(f"Обработка sitemap: {sitemap_url}")
+            print(f"{'='*60}")
             
-            # Извлекаем все ссылки на sitemap файлы
-            sitemap_links = []
-            for sitemap_elem in root.findall('ns:sitemap', namespace):
-                loc = sitemap_elem.find('ns:loc', namespace)
-                lastmod = sitemap_elem.find('ns:lastmod', namespace)
-                if loc is not None:
-                    sitemap_info = {
-                        'url': loc.text,
-                        'lastmod': lastmod.text if lastmod is not None else None
-                    }
-                    sitemap_links.append(sitemap_info)
-                    print(f"Sitemap: {sitemap_info['url']} (Last modified: {sitemap_info['lastmod']})")
+            response, headers = await _fetch_sitemap_async(client, sitemap_url, headers)
+            if response.status_code != 200:
+                print(f"Ошибка при получении sitemap {sitemap_url}: {response.status_code}")
+                continue
             
+            sitemap_links = list(_iter_sitemap_index(io.BytesIO(response.content)))
             print(f"\nВсего найдено sitemap файлов: {len(sitemap_links)}")
             
-            # Парсим все sitemap файлы для получения URL страниц
-            if sitemap_links:
-                for idx, sitemap_info in enumerate(sitemap_links, 1):
-                    print(f"\nПарсим sitemap {idx}/{len(sitemap_links)}: {sitemap_info['url']}")
-                    # Пытаемся получить sitemap файл с retry при 403
-                    max_retries = 3
-                    sitemap_response = None
-                    for attempt in range(max_retries):
-                        sitemap_response = requests.get(sitemap_info['url'], headers=headers)
-                        if sitemap_response.status_code == 200:
-                            break
-                        elif sitemap_response.status_code == 403:
-                            if attempt < max_retries - 1:
-                                print(f"  403 ошибка, попытка {attempt + 1}/{max_retries}: заменяем User-Agent...")
-                                headers = update_user_agent_in_headers(headers)
-                            else:
-                                print(f"  403 ошибка после {max_retries} попыток")
-                        else:
-                            break
-                    
-                    if sitemap_response and sitemap_response.status_code == 200:
-                        sitemap_root = ET.fromstring(sitemap_response.content)
-                        urls_count = 0
-                        for url_elem in sitemap_root.findall('ns:url', namespace):
-                            loc = url_elem.find('ns:loc', namespace)
-                            if loc is not None:
-                                # Возвращаем URL по мере получения
-                                yield loc.text
+            url_queue = asyncio.Queue(maxsize=_SITEMAP_QUEUE_SIZE)
+            semaphore = asyncio.Semaphore(concurrency)
+            
+            async def fetch_child(sitemap_info: dict) -> None:
+                # Заголовки общие для всех дочерних sitemap: после замены User-Agent на 403
+                # следующие загрузки идут уже с новым, как в последовательной версии
+                nonlocal headers
+                urls_count = 0
+                async with semaphore:
+                    try:
+                        child_response, headers = await _fetch_sitemap_async(
+                            client, sitemap_info['url'], headers, stream=True
+                        )
+                        try:
+                            if child_response.status_code != 200:
+                                print(f"  Ошибка при получении sitemap {sitemap_info['url']}: {child_response.status_code}")
+                                return
+                            async for loc in _aiter_sitemap_locs(child_response):
+                                await url_queue.put(loc)
                                 urls_count += 1
-                                total_urls_count += 1
-                        
-                        print(f"  Найдено URL страниц: {urls_count}")
-                    else:
-                        print(f"  Ошибка при получении sitemap {sitemap_info['url']}: {sitemap_response.status_code}")
-        else:
-            print(f"Ошибка при получении sitemap {sitemap_url}: {response.status_code}")
+                        finally:
+                            await child_response.aclose()
+                    except httpx.HTTPError as e:
+                        print(f"  Ошибка при получении sitemap {sitemap_info['url']}: {e}")
+                        return
+                print(f"  {sitemap_info['url']}: найдено URL страниц {urls_count}")
+            
+            async def produce() -> None:
+                # None - признак того, что все дочерние sitemap обработаны. При отмене
+                # (потребитель закрыл генератор) его уже никто не прочитает
+                try:
+                    await asyncio.gather(*(fetch_child(sitemap_info) for sitemap_info in sitemap_links))
+                except asyncio.CancelledError:
+                    raise
+                except Exception:
+                    await url_queue.put(None)
+                    raise
+                await url_queue.put(None)
+            
+            producer = asyncio.create_task(produce())
+            try:
+                while (loc := await url_queue.get()) is not None:
+                    yield loc
+                    total_urls_count += 1
+                await producer
+            finally:
+                producer.cancel()
     
     print(f"\nВсего обработано URL из всех sitemap файлов: {total_urls_count}")
 
+
+def process_sitemaps_generator(headers: dict = None, concurrency: int = 10) -> Iterator[str]:
+    """
+    Синхронная обертка над process_sitemaps_async для обратной совместимости.
+    Async-генератор выполняется в отдельном потоке со своим event loop, а URL передаются
+    через ограниченную очередь: если потребитель не успевает, загрузка sitemap приостанавливается.
+    Закрытие генератора (break в цикле потребителя) останавливает фоновый поток.
+    
+    Yields:
+        str: URL страницы из sitemap
+    """
+    url_queue = queue.Queue(maxsize=_SITEMAP_QUEUE_SIZE)
+    stop = threading.Event()
+    done = object()
+    
+    def put(item) -> bool:
+        # Ждем место в очереди, пока потребитель не закрыл генератор
+        while not stop.is_set():
+            try:
+                url_queue.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                continue
+        return False
+    
+    async def drain() -> None:
+        locs = process_sitemaps_async(headers, concurrency)
+        try:
+            async for loc in locs:
+                if not put(loc):
+                    return
+        finally:
+            await locs.aclose()
+    
+    def run() -> None:
+        try:
+            asyncio.run(drain())
+        except BaseException as e:
+            put(e)
+        else:
+            put(done)
+    
+    thread = threading.Thread(target=run, name='sitemaps', daemon=True)
+    thread.start()
+    try:
+        while (item := url_queue.get()) is not done:
+            if isinstance(item, BaseException):
+                raise item
+            yield item
+    finally:
+        stop.set()
+        thread.join()
+
 # ========== Получение всех ссылок на объявления с пагинацией (асинхронная версия) ==========
 
-async def fetch_page_links(
-    client: httpx.AsyncClient,
-    api_url: str,
-    page: int,
-    start: int,
-    num_per_page: int,
+def _extract_listings(data: dict) -> list:
+    """
+    Достает список объявлений из ответа API поиска.
+    Поддерживает форматы {'data': [...]}, {'data': {'listing': ...}},
+    {'data': {'listings': [...]}} и {'lolResults': {'data': [...]}}
+    """
+    listings = data.get('data') or (data.get('lolResults') or {}).get('data') or []
+    if type(listings) is dict:
+        listings = [listings] if 'listing' in listings else listings.get('listings') or []
+    return listings
+
+
+def _extract_nav_links(listings: list) -> list[str]:
+    """Полные ссылки на объявления (navigationPageLink) из списка _extract_listings"""
+    base = BASE_URL
+    # Убираем начальный слэш, чтобы избежать двойного слэша
+    return [
+        f"{base}/{link.lstrip('/')}"
+        for item in listings
+        if type(item) is dict
+        and type(listing := item.get('listing', item)) is dict
+        and (link := listing.get('navigationPageLink'))
+    ]
+
+
+# Как часто (в страницах выдачи) печатать прогресс сбора ссылок без verbose:
+# печать на каждую страницу забивает вывод и занимает event loop
+_PROGRESS_EVERY = 100
+
+# Статусы, при которых запрос повторяется после паузы
+_RETRY_STATUSES = frozenset({429, 500, 502, 503, 504})
+
+
+def _retry_delay(attempt: int, response: httpx.Response | None = None, base: float = 1.0, cap: float = 30.0) -> float:
+    """
+    Задержка перед повтором запроса: Retry-After из ответа, если сервер его прислал (в секундах),
+    иначе случайная величина от 0 до base * 2**attempt (full jitter), не больше cap
+    """
+    if response is not None:
+        retry_after = response.headers.get('Retry-After', '')
+        if retry_after.isdigit():
+            return min(float(retry_after), cap)
+    return random.uniform(0, min(cap, base * 2 ** attempt))
+
+
+class RateLimiter:
+    """
+    Token bucket: в среднем не больше rate запросов в секунду, всплеск - до burst запросов.
+    Ограничивает именно частоту запросов, а не их количество в полете (за это отвечает семафор)
+    """
+    
+    def __init__(self, rate: float, burst: int = 1) -> None:
+        self.rate = rate
+        self.burst = burst
+        self.tokens = float(burst)
+        self.updated = time.monotonic()
+        self._lock = asyncio.Lock()
+    
+    async def acquire(self) -> None:
+        # Ожидающие встают в очередь на lock, поэтому токены выдаются по порядку
+        async with self._lock:
+            while True:
+                now = time.monotonic()
+                self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                await asyncio.sleep((1 - self.tokens) / self.rate)
+    
+    async def __aenter__(self) -> 'RateLimiter':
+        await self.acquire()
+        return self
+    
+    async def __aexit__(self, exc_type, exc, tb) -> None:
+        pass
+
+
+class AdmissionController:
+    """
+    Ограничивает количество одновременных запросов, как asyncio.Semaphore,
+    но позволяет безопасно менять лимит на ходу (set_limit).
+    
+    Счетчик активных запросов защищен asyncio.Condition: acquire ждет, пока
+    active < limit, release уменьшает счетчик и будит одного ожидающего.
+    Дополнительно считает ответы 429/503 и сетевые ошибки (таймауты, обрывы соединения),
+    по которым watchdog подстраивает лимит.
+    """
+    
+    def __init__(self, limit: int) -> None:
+        self.limit = limit
+        self.active = 0
+        self.throttled = 0
+        self._condition = asyncio.Condition()
+    
+    async def acquire(self) -> None:
+        async with self._condition:
+            await self._condition.wait_for(lambda: self.active < self.limit)
+            self.active += 1
+    
+    async def release(self) -> None:
+        async with self._condition:
+            self.active -= 1
+            self._condition.notify(1)
+    
+    async def set_limit(self, limit: int) -> None:
+        """Меняет лимит (не меньше 1) и будит ожидающих, если лимит вырос"""
+        async with self._condition:
+            self.limit = max(1, limit)
+            self._condition.notify_all()
+    
+    def report(self, status_code: int) -> None:
+        """Учитывает статус ответа: 429/503 означают, что сервер нас ограничивает"""
+        if status_code in (429, 503):
+            self.throttled += 1
+    
+    def report_error(self) -> None:
+        """Учитывает сетевую ошибку: таймаут под нагрузкой - такой же признак перегрузки, как 503"""
+        self.throttled += 1
+    
+    async def __aenter__(self) -> 'AdmissionController':
+        await self.acquire()
+        return self
+    
+    async def __aexit__(self, exc_type, exc, tb) -> None:
+        await self.release()
+
+
+async def admission_watchdog(admission: AdmissionController, max_limit: int, interval: float = 5.0) -> None:
+    """
+    Раз в interval секунд подстраивает лимит: если за период были ответы 429/503 или сетевые ошибки,
+    уменьшает его вдвое, иначе увеличивает на 1 (но не выше max_limit).
+    Работает до отмены задачи.
+    """
+    while True:
+        await asyncio.sleep(interval)
+        throttled, admission.throttled = admission.throttled, 0
+        if throttled:
+            await admission.set_limit(admission.limit // 2)
+            print(f"Получено {throttled} ответов 429/503 и сетевых ошибок, снижаем параллелизм до {admission.limit}")
+        elif admission.limit < max_limit:
+            await admission.set_limit(admission.limit + 1)
+
+
+@lru_cache(maxsize=4096)
+def _search_query_param(start: int) -> str:
+    """
+    Значение параметра searchQuery для страницы с данным смещением.
+    Смещения (40, 80, ...) одинаковы для всех location'ов, поэтому строка сериализуется один раз
+    """
+    return json.dumps({"sort": {"column": "dom", "direction": "asc"}, "start": start})
+
+
+def _page_request_template(
     search_result_id: str,
     location_ids: list,
     viewport_ne: dict,
     viewport_sw: dict,
-    post_headers: dict
-) -> tuple[int, list]:
+    num_per_page: int
+) -> dict:
     """
-    Асинхронно получает ссылки с одной страницы
-    
-    Returns:
-        tuple: (page_number, list_of_links)
+    Собирает тело POST-запроса страницы выдачи со start=0.
+    Для конкретной страницы подменяется только rawLolSearchQuery.start (см. fetch_page_links)
     """
-    search_query = {
-        "sort": {"column": "dom", "direction": "asc"},
-        "start": start
-    }
-    params = {
-        'searchQuery': json.dumps(search_query),
-    }
-    
     raw_query = {
         'listingTypes': [2],
         'saleStatuses': [12, 9],
         'num': num_per_page,
-        'start': start,
+        'start': 0,
         'sortOrder': 46,
         'facetFieldNames': [
             'contributingDatasetList',
@@ -196,97 +588,214 @@ async def fetch_page_links(
         'isMapFullyInitialized': True,
         'purpose': 'search',
     }
+    return json_data
+
+
+async def fetch_page_links(
+    client: httpx.AsyncClient,
+    api_url: str,
+    page: int,
+    start: int,
+    num_per_page: int,
+    search_result_id: str,
+    location_ids: list,
+    viewport_ne: dict,
+    viewport_sw: dict,
+    post_headers: dict,
+    limiter: RateLimiter | None = None,
+    base_json_data: dict | None = None,
+    admission: AdmissionController | None = None
+) -> tuple[int, list, int]:
+    """
+    Асинхронно получает ссылки с одной страницы
     
-    try:
-        # Пытаемся выполнить запрос с retry при 403
-        max_retries = 3
-        response = None
-        for attempt in range(max_retries):
+    Args:
+        limiter: Ограничитель частоты запросов (опционально), ждем токен перед каждой попыткой
+        base_json_data: Готовый шаблон тела запроса из _page_request_template (опционально).
+                        Если не передан, собирается из location_ids и viewport.
+        admission: Ограничитель одновременных запросов (опционально), получает статус каждого ответа
+                   и сетевые ошибки
+    
+    Returns:
+        tuple: (page_number, list_of_links, listings_count). listings_count - число объявлений
+               на странице (у части объявлений может не быть ссылки), по нему видно конец выдачи
+    
+    Raises:
+        httpx.HTTPError, json.JSONDecodeError: если страницу не удалось получить после всех попыток -
+               ошибка не маскируется под пустую страницу
+    """
+    if base_json_data is None:
+        base_json_data = _page_request_template(
+            search_result_id, location_ids, viewport_ne, viewport_sw, num_per_page
+        )
+    params = {'searchQuery': _search_query_param(start)}
+    # Неглубокие копии: общий шаблон не меняется, меняется только start
+    json_data = {**base_json_data, 'rawLolSearchQuery': {**base_json_data['rawLolSearchQuery'], 'start': start}}
+    
+    # Пытаемся выполнить запрос с retry: при 403 меняем User-Agent,
+    # при 429/5xx ждем (Retry-After или экспоненциальная задержка)
+    max_retries = 3
+    response = None
+    for attempt in range(max_retries):
+        is_last = attempt == max_retries - 1
+        if limiter is not None:
+            await limiter.acquire()
+        try:
             response = await client.post(
                 api_url,
                 params=params,
                 json=json_data,
                 headers=post_headers,
-                timeout=30.0
             )
-            if response.status_code == 200:
-                break
-            elif response.status_code == 403:
-                if attempt < max_retries - 1:
-                    print(f"  403 ошибка, попытка {attempt + 1}/{max_retries}: заменяем User-Agent...")
-                    post_headers = update_user_agent_in_headers(post_headers)
-                else:
-                    print(f"  403 ошибка после {max_retries} попыток")
-                    response.raise_for_status()
-                    break
+        except httpx.TransportError:
+            if admission is not None:
+                admission.report_error()
+            raise
+        if admission is not None:
+            admission.report(response.status_code)
+        if response.status_code == 200:
+            break
+        elif response.status_code == 403:
+            if not is_last:
+                print(f"  403 ошибка, попытка {attempt + 1}/{max_retries}: заменяем User-Agent...")
+                post_headers = update_user_agent_in_headers(post_headers)
             else:
+                print(f"  403 ошибка после {max_retries} попыток")
                 response.raise_for_status()
                 break
-        
-        if not response:
-            raise Exception("Не удалось получить ответ от сервера")
-        
-        response.raise_for_status()
-        data = response.json()
-        
-        # Извлекаем данные из ответа
-        listings = []
-        
-        if 'data' in data:
-            if isinstance(data['data'], list):
-                listings = data['data']
-            elif isinstance(data['data'], dict):
-                if 'listing' in data['data']:
-                    listings = [data['data']]
-                elif isinstance(data['data'].get('listings'), list):
-                    listings = data['data']['listings']
-        elif 'lolResults' in data:
-            if 'data' in data['lolResults']:
-                listings = data['lolResults']['data']
-        
-        # Извлекаем navigationPageLink
-        page_links = []
-        for item in listings:
-            listing = None
-            if 'listing' in item:
-                listing = item['listing']
-            elif isinstance(item, dict) and 'navigationPageLink' in item:
-                listing = item
-            else:
-                listing = item
-            
-            if listing and isinstance(listing, dict):
-                navigation_link = listing.get('navigationPageLink')
-                if navigation_link:
-                    full_url = f'{BASE_URL}{navigation_link}'
-                    page_links.append(full_url)
-        
-        return (page, page_links)
-        
-    except Exception as e:
-        print(f"Ошибка при запросе страницы {page + 1}: {e}")
-        return (page, [])
+        elif response.status_code in _RETRY_STATUSES and not is_last:
+            delay = _retry_delay(attempt, response)
+            print(f"  Ответ {response.status_code} на странице {page + 1}, повтор через {delay:.1f} с...")
+            await asyncio.sleep(delay)
+        else:
+            response.raise_for_status()
+            break
+    
+    if not response:
+        raise Exception("Не удалось получить ответ от сервера")
+    
+    response.raise_for_status()
+    # Страница выдачи - сотни объявлений; orjson разбирает байты ответа без промежуточного str
+    data = _json_loads(response.content)
+    
+    listings = _extract_listings(data)
+    return (page, _extract_nav_links(listings), len(listings))
 
 
-async def get_all_listing_links_async(location_url: str, concurrency: int = 10):
+async def iter_bounded(coros: Iterable[Awaitable], limit: int) -> AsyncIterator:
     """
-    Асинхронно получает все ссылки на объявления (navigationPageLink) со всех страниц
+    Выполняет корутины, держа одновременно в работе не более limit задач,
+    и отдает результаты по мере завершения (в порядке готовности).
+    Как и asyncio.gather(..., return_exceptions=True), вместо результата
+    упавшей задачи отдает её исключение.
+    
+    Память не растет с количеством корутин: новые задачи создаются
+    только на место завершившихся.
+    """
+    pending = iter(coros)
+    in_flight = {asyncio.ensure_future(coro) for coro in itertools.islice(pending, limit)}
+    try:
+        while in_flight:
+            done, in_flight = await asyncio.wait(in_flight, return_when=asyncio.FIRST_COMPLETED)
+            in_flight.update(asyncio.ensure_future(coro) for coro in itertools.islice(pending, len(done)))
+            for task in done:
+                exc = task.exception()
+                yield exc if exc is not None else task.result()
+    finally:
+        for task in in_flight:
+            task.cancel()
+
+
+class LinksJsonlWriter:
+    """
+    Дописывает ссылки каждой загруженной страницы выдачи в JSONL-файл
+    (по строке {"location": ..., "page": ..., "links": [...]} на страницу).
+    Пишет одна фоновая корутина из asyncio.Queue, поэтому строки от параллельных
+    страниц не перемешиваются, а при падении уже собранные ссылки остаются на диске
+    """
+    
+    def __init__(self, path: str, location_url: str) -> None:
+        self.path = path
+        self.location_url = location_url
+        self._queue = asyncio.Queue()
+        self._file = None
+        self._task = None
+    
+    def record(self, page_num: int, links: list[str]) -> None:
+        self._queue.put_nowait((page_num, links))
+    
+    async def _run(self) -> None:
+        while (item := await self._queue.get()) is not None:
+            page_num, links = item
+            self._file.write(_json_line({'location': self.location_url, 'page': page_num, 'links': links}))
+            self._file.flush()
     
+    async def __aenter__(self) -> 'LinksJsonlWriter':
+        self._file = open(self.path, 'ab')
+        self._task = asyncio.create_task(self._run())
+        return self
+    
+    async def __aexit__(self, exc_type, exc, tb) -> None:
+        self._queue.put_nowait(None)
+        try:
+            await self._task
+        finally:
+            self._file.close()
+
+
+def new_search_client(concurrency: int = 10) -> httpx.AsyncClient:
+    """
+    Создает AsyncClient для запросов к поиску compass. Его можно передать в
+    get_all_listing_links_async для нескольких локаций подряд, чтобы не открывать
+    TLS-соединение заново для каждой
+    """
+    # Все запросы идут на один origin: по HTTP/2 они мультиплексируются в одном соединении,
+    # а при откате на HTTP/1.1 пул соединений ограничен, чтобы всплеск задач не открывал сотни сокетов.
+    # Запас keep-alive соединений вдвое больше concurrency, чтобы на длинных прогонах они
+    # не закрывались и не открывались заново; keepalive_expiry переживает паузу между локациями
+    limits = httpx.Limits(
+        max_connections=concurrency * 4,
+        max_keepalive_connections=concurrency * 2,
+        keepalive_expiry=60.0,
+    )
+    timeout = httpx.Timeout(30.0, connect=10.0)
+    
+    # При явном transport параметры http2/limits задаются на нем, а не на клиенте
+    transport = httpx.AsyncHTTPTransport(http2=True, limits=limits, retries=_CONNECT_RETRIES)
+    return httpx.AsyncClient(transport=transport, timeout=timeout)
+
+
+async def get_all_listing_links_async(
+    location_url: str,
+    concurrency: int = 10,
+    rate_limit: float = 10.0,
+    links_file: str | None = None,
+    client: httpx.AsyncClient | None = None,
+    verbose: bool = False
+):
+    """
+    Асинхронно получает все ссылки на объявления (navigationPageLink) со всех страниц
+
     Args:
         location_url: URL страницы, например 'https://www.compass.com/homes-for-sale/arizona/'
         concurrency: Количество одновременных запросов (по умолчанию 10)
-    
+        rate_limit: Максимальная средняя частота запросов страниц в секунду (по умолчанию 10)
+        links_file: JSONL-файл, в который ссылки дописываются по мере загрузки страниц (опционально)
+        client: Общий клиент для нескольких локаций (опционально, см. new_search_client);
+                без него создается и закрывается собственный клиент
+        verbose: Печатать результат каждой страницы (по умолчанию - сводка раз в _PROGRESS_EVERY страниц)
+
     Returns:
         list: Массив всех ссылок на объявления
     """
     get_headers = {
-        'User-Agent': UserAgent().random,
+        'User-Agent': get_new_user_agent(),
         'Accept': 'text/html,application/xhtml+xml,application/xml;q=0.9,*/*;q=0.8',
         'Accept-Language': 'en-US,en;q=0.5',
     }
-    
+
     post_headers = {
-        'User-Agent': UserAgent().random,
+        'User-Agent': get_new_user_agent(),
         'Accept': '*/*',
         'Accept-Language': 'en-US,en;q=0.5',
         'Referer': location_url,
@@ -301,388 +810,482 @@ async def get_all_listing_links_async(location_url: str, concurrency: int = 10):
     }
 
     num_per_page = 40
-    search_result_id = str(uuid.uuid4())
+    # Идентификатору сессии поиска достаточно быть уникальным, криптостойкость не нужна:
+    # uuid1 строится из времени и узла (с защитой от повторов внутри одного тика)
+    # без чтения /dev/urandom на каждый вызов, как uuid4
+    search_result_id = str(uuid.uuid1())
     location_ids = None
     viewport_ne = None
     viewport_sw = None
     api_url = location_url.rstrip('/')
-    
+
     # Пытаемся извлечь координаты из URL, если там есть mapview
     # Например: /homes-for-sale/arizona/mapview=37.0,-109.0,31.0,-114.0/
-    mapview_match = re.search(r'mapview=([\d.-]+),([\d.-]+),([\d.-]+),([\d.-]+)', location_url)
+    mapview_match = _MAPVIEW_RE.search(location_url)
     if mapview_match:
         viewport_ne = {'lat': float(mapview_match.group(1)), 'lng': float(mapview_match.group(2))}
         viewport_sw = {'lat': float(mapview_match.group(3)), 'lng': float(mapview_match.group(4))}
         print(f"Координаты извлечены из URL: NE={viewport_ne}, SW={viewport_sw}")
-    
+
     print(f"\nНачинаем асинхронный сбор ссылок на объявления из: {location_url}")
     print(f"Concurrency: {concurrency}")
-    
-    # Создаем семафор для ограничения количества одновременных запросов
-    semaphore = asyncio.Semaphore(concurrency)
-    
-    async with httpx.AsyncClient() as client:
-        # Если координаты не были извлечены из URL, используем дефолтные широкие координаты для первого запроса
-        # Они будут обновлены из ответа API
-        if not viewport_ne or not viewport_sw:
-            # Дефолтные координаты для США (широкий охват)
-            viewport_ne = {'lat': 49.0, 'lng': -66.0}
-            viewport_sw = {'lat': 24.0, 'lng': -125.0}
-            print("Используем дефолтные координаты для первого запроса, будут обновлены из ответа API")
-        
-        # Делаем первый запрос для получения locationIds, координат и определения общего количества страниц
-        print("Получаем начальные параметры...")
-        async with semaphore:
-            try:
-                search_query = {"sort": {"column": "dom", "direction": "asc"}, "start": 0}
-                params = {'searchQuery': json.dumps(search_query)}
-                raw_query = {
-                    'listingTypes': [2],
-                    'saleStatuses': [12, 9],
-                    'num': num_per_page,
-                    'start': 0,
-                    'sortOrder': 46,
-                    'facetFieldNames': ['contributingDatasetList', 'compassListingTypes', 'comingSoon'],
-                }
-                
-                # Добавляем координаты только если они есть
-                if viewport_ne and viewport_sw:
-                    raw_query['nePoint'] = {'latitude': viewport_ne['lat'], 'longitude': viewport_ne['lng']}
-                    raw_query['swPoint'] = {'latitude': viewport_sw['lat'], 'longitude': viewport_sw['lng']}
-                
-                json_data = {
-                    'searchResultId': search_result_id,
-                    'rawLolSearchQuery': raw_query,
-                    'viewport': {'northeast': viewport_ne, 'southwest': viewport_sw} if viewport_ne and viewport_sw else {},
-                    'viewportFrom': 'response',
-                    'height': 1350,
-                    'width': 1253,
-                    'isMapFullyInitialized': True,
-                    'purpose': 'search',
-                }
-
-                # Пытаемся выполнить запрос с retry при 403
-                max_retries = 3
-                response = None
-                for attempt in range(max_retries):
-                    response = await client.post(api_url, params=params, json=json_data, headers=post_headers, timeout=30.0)
-                    if response.status_code == 200:
-                        break
-                    elif response.status_code == 403:
-                        if attempt < max_retries - 1:
-                            print(f"  403 ошибка, попытка {attempt + 1}/{max_retries}: заменяем User-Agent...")
-                            post_headers = update_user_agent_in_headers(post_headers)
-                        else:
-                            print(f"  403 ошибка после {max_retries} попыток")
+
+    # Ограничитель одновременных запросов: watchdog уменьшает лимит вдвое при ответах 429/503
+    # и возвращает его по одному, пока сервер не ограничивает (как при загрузке объявлений),
+    # а token bucket ограничивает их частоту, чтобы не упираться в 429 от compass
+    admission = AdmissionController(concurrency)
+    limiter = RateLimiter(rate_limit, burst=concurrency)
+
+    if client is None:
+        client_context = new_search_client(concurrency)
+    else:
+        # Клиент вызывающего переиспользуется между локациями и закрывается им самим
+        client_context = contextlib.nullcontext(client)
+
+    links_writer = LinksJsonlWriter(links_file, location_url) if links_file else None
+
+    async with client_context as client, (links_writer or contextlib.nullcontext()):
+        watchdog = asyncio.create_task(admission_watchdog(admission, max_limit=concurrency))
+        try:
+            # Если координаты не были извлечены из URL, используем дефолтные широкие координаты для первого запроса
+            # Они будут обновлены из ответа API
+            if not viewport_ne or not viewport_sw:
+                # Дефолтные координаты для США (широкий охват)
+                viewport_ne = {'lat': 49.0, 'lng': -66.0}
+                viewport_sw = {'lat': 24.0, 'lng': -125.0}
+                print("Используем дефолтные координаты для первого запроса, будут обновлены из ответа API")
+
+            # Делаем первый запрос для получения locationIds, координат и определения общего количества страниц
+            print("Получаем начальные параметры...")
+            async with admission:
+                try:
+                    params = {'searchQuery': _search_query_param(0)}
+                    raw_query = {
+                        'listingTypes': [2],
+                        'saleStatuses': [12, 9],
+                        'num': num_per_page,
+                        'start': 0,
+                        'sortOrder': 46,
+                        'facetFieldNames': ['contributingDatasetList', 'compassListingTypes', 'comingSoon'],
+                    }
+
+                    # Добавляем координаты только если они есть
+                    if viewport_ne and viewport_sw:
+                        raw_query['nePoint'] = {'latitude': viewport_ne['lat'], 'longitude': viewport_ne['lng']}
+                        raw_query['swPoint'] = {'latitude': viewport_sw['lat'], 'longitude': viewport_sw['lng']}
+
+                    json_data = {
+                        'searchResultId': search_result_id,
+                        'rawLolSearchQuery': raw_query,
+                        'viewport': {'northeast': viewport_ne, 'southwest': viewport_sw} if viewport_ne and viewport_sw else {},
+                        'viewportFrom': 'response',
+                        'height': 1350,
+                        'width': 1253,
+                        'isMapFullyInitialized': True,
+                        'purpose': 'search',
+                    }
+
+                    # Первый запрос на критическом пути: от него зависят все остальные страницы.
+                    # При временной ошибке (сетевая, 5xx) повторяем его с экспоненциальной задержкой
+                    bootstrap_attempts = 3
+                    for bootstrap_attempt in range(bootstrap_attempts):
+                        try:
+                            # Пытаемся выполнить запрос с retry при 403
+                            max_retries = 3
+                            response = None
+                            for attempt in range(max_retries):
+                                # Тот же token bucket и учет 429/503 и сетевых ошибок, что и у fetch_page_links:
+                                # первый запрос чаще всех упирается в 429
+                                await limiter.acquire()
+                                try:
+                                    response = await client.post(api_url, params=params, json=json_data, headers=post_headers)
+                                except httpx.TransportError:
+                                    admission.report_error()
+                                    raise
+                                admission.report(response.status_code)
+                                if response.status_code == 200:
+                                    break
+                                elif response.status_code == 403:
+                                    if attempt < max_retries - 1:
+                                        print(f"  403 ошибка, попытка {attempt + 1}/{max_retries}: заменяем User-Agent...")
+                                        post_headers = update_user_agent_in_headers(post_headers)
+                                    else:
+                                        print(f"  403 ошибка после {max_retries} попыток")
+                                        response.raise_for_status()
+                                        break
+                                else:
+                                    response.raise_for_status()
+                                    break
+
+                            if not response:
+                                raise Exception("Не удалось получить ответ от сервера")
+
                             response.raise_for_status()
+                            data = _json_loads(response.content)
                             break
+                        except httpx.HTTPError as e:
+                            transient = not isinstance(e, httpx.HTTPStatusError) or e.response.status_code in _RETRY_STATUSES
+                            if not transient or bootstrap_attempt == bootstrap_attempts - 1:
+                                raise
+                            delay = 0.2 * 2 ** bootstrap_attempt
+                            print(f"  Ошибка первого запроса ({e}), повтор через {delay:.1f} с...")
+                            await asyncio.sleep(delay)
+
+                    # Получаем viewport из ответа, если его там нет
+                    if 'viewport' in data:
+                        resp_viewport = data['viewport']
+                        if 'northeast' in resp_viewport and 'southwest' in resp_viewport:
+                            viewport_ne = resp_viewport['northeast']
+                            viewport_sw = resp_viewport['southwest']
+                            print(f"Координаты получены из ответа API: NE={viewport_ne}, SW={viewport_sw}")
+
+                    # Получаем locationIds из ответа
+                    if 'rawLolSearchQuery' in data and 'locationIds' in data.get('rawLolSearchQuery', {}):
+                        location_ids = data['rawLolSearchQuery']['locationIds']
+                        print(f"Найдены locationIds: {location_ids}")
+
+                    # Извлекаем ссылки из первого ответа
+                    first_listings = _extract_listings(data)
+                    first_links = _extract_nav_links(first_listings)
+                    if links_writer and first_links:
+                        links_writer.record(0, first_links)
+
+                    all_links = first_links.copy()
+                    print(f"Первая страница: найдено {len(first_links)} ссылок")
+
+                    # Пытаемся определить общее количество страниц
+                    total_items = 0
+                    if 'lolResults' in data:
+                        total_items = data['lolResults'].get('totalItems', 0)
+                    elif 'data' in data and isinstance(data['data'], dict):
+                        total_items = data['data'].get('totalItems', 0)
+
+                    # Также проверяем другие возможные поля
+                    if total_items == 0:
+                        if 'total' in data:
+                            total_items = data.get('total', 0)
+                        if 'totalCount' in data:
+                            total_items = data.get('totalCount', 0)
+
+                    if total_items > 0:
+                        total_pages = (total_items + num_per_page - 1) // num_per_page
+                        print(f"Всего объявлений: {total_items}, страниц: {total_pages} (по {num_per_page} на страницу)")
                     else:
-                        response.raise_for_status()
-                        break
-                
-                if not response:
-                    raise Exception("Не удалось получить ответ от сервера")
-                
-                response.raise_for_status()
-                data = response.json()
-                
-                # Получаем viewport из ответа, если его там нет
-                if 'viewport' in data:
-                    resp_viewport = data['viewport']
-                    if 'northeast' in resp_viewport and 'southwest' in resp_viewport:
-                        viewport_ne = resp_viewport['northeast']
-                        viewport_sw = resp_viewport['southwest']
-                        print(f"Координаты получены из ответа API: NE={viewport_ne}, SW={viewport_sw}")
-                
-                # Получаем locationIds из ответа
-                if 'rawLolSearchQuery' in data and 'locationIds' in data.get('rawLolSearchQuery', {}):
-                    location_ids = data['rawLolSearchQuery']['locationIds']
-                    print(f"Найдены locationIds: {location_ids}")
-                
-                # Извлекаем ссылки из первого ответа
-                listings = []
-                if 'data' in data:
-                    if isinstance(data['data'], list):
-                        listings = data['data']
-                    elif isinstance(data['data'], dict):
-                        if 'listing' in data['data']:
-                            listings = [data['data']]
-                        elif isinstance(data['data'].get('listings'), list):
-                            listings = data['data']['listings']
-                elif 'lolResults' in data:
-                    if 'data' in data['lolResults']:
-                        listings = data['lolResults']['data']
-                
-                # Извлекаем navigationPageLink из первого ответа
-                first_links = []
-                for item in listings:
-                    listing = None
-                    if 'listing' in item:
-                        listing = item['listing']
-                    elif isinstance(item, dict) and 'navigationPageLink' in item:
-                        listing = item
-                    else:
-                        listing = item
-                    
-                    if listing and isinstance(listing, dict):
-                        navigation_link = listing.get('navigationPageLink')
-                        if navigation_link:
-                            # Убираем начальный слэш, если есть, чтобы избежать двойного слэша
-                            nav_path = navigation_link.lstrip('/')
-                            full_url = f'{BASE_URL}/{nav_path}'
-                            first_links.append(full_url)
-                
-                all_links = first_links.copy()
-                print(f"Первая страница: найдено {len(first_links)} ссылок")
-                
-                # Пытаемся определить общее количество страниц
-                total_items = 0
-                if 'lolResults' in data:
-                    total_items = data['lolResults'].get('totalItems', 0)
-                elif 'data' in data and isinstance(data['data'], dict):
-                    total_items = data['data'].get('totalItems', 0)
-                
-                # Также проверяем другие возможные поля
-                if total_items == 0:
-                    if 'total' in data:
-                        total_items = data.get('total', 0)
-                    if 'totalCount' in data:
-                        total_items = data.get('totalCount', 0)
-                
-                if total_items > 0:
-                    total_pages = (total_items + num_per_page - 1) // num_per_page
-                    print(f"Всего объявлений: {total_items}, страниц: {total_pages} (по {num_per_page} на страницу)")
-                else:
-                    # Если не знаем общее количество, будем запрашивать до пустого ответа
+                        # Если не знаем общее количество, будем запрашивать до пустого ответа
+                        total_pages = None
+                        print("Не удалось определить общее количество страниц, будем запрашивать до пустого ответа")
+                except Exception as e:
+                    print(f"Ошибка при получении начальных данных: {e}")
+                    traceback.print_exc()
                     total_pages = None
-                    print("Не удалось определить общее количество страниц, будем запрашивать до пустого ответа")
-            except Exception as e:
-                print(f"Ошибка при получении начальных данных: {e}")
-                import traceback
-                traceback.print_exc()
-                total_pages = None
-                all_links = []
-        
-        # Если получили меньше результатов, чем запрашивали, значит это последняя страница
-        if len(first_links) < num_per_page:
-            print("Получено меньше результатов на первой странице, завершаем.")
-            return all_links
-        
-        # Если знаем общее количество страниц, создаем задачи для всех с семафором
-        if total_pages:
-            print(f"\nЗапускаем параллельные запросы для {total_pages - 1} страниц...")
-            
-            # Создаем задачи с семафором
-            async def fetch_with_semaphore(page_num):
-                async with semaphore:
-                    return await fetch_page_links(
-                        client, api_url, page_num, page_num * num_per_page, num_per_page,
-                        search_result_id, location_ids, viewport_ne, viewport_sw, post_headers
-                    )
-            
-            semaphore_tasks = [
-                fetch_with_semaphore(page_num) 
-                for page_num in range(1, total_pages)
-            ]
-            
-            # Выполняем все задачи
-            results = await asyncio.gather(*semaphore_tasks, return_exceptions=True)
-            
-            # Обрабатываем результаты
-            successful_pages = 0
-            failed_pages = 0
-            for result in results:
-                if isinstance(result, Exception):
-                    print(f"Ошибка на странице: {result}")
-                    failed_pages += 1
-                    continue
-                
-                page_num, links = result
-                if links:
-                    all_links.extend(links)
-                    successful_pages += 1
-                    if (page_num + 1) % 50 == 0 or page_num == 0:
-                        print(f"Обработано страниц: {page_num + 1}/{total_pages - 1}, собрано ссылок: {len(all_links)}")
-                else:
-                    print(f"Предупреждение: страница {page_num + 1} вернула пустой результат")
-            
-            print(f"\nОбработано успешно: {successful_pages} страниц, ошибок: {failed_pages}")
-            print(f"Ожидалось страниц: {total_pages - 1}, обработано: {successful_pages + failed_pages}")
-            print(f"Итого собрано ссылок: {len(all_links)}")
-            
-            # Проверяем, что мы получили все страницы
-            if successful_pages + failed_pages < total_pages - 1:
-                print(f"ВНИМАНИЕ: Обработано меньше страниц, чем ожидалось!")
-                print(f"Ожидалось: {total_pages - 1}, обработано: {successful_pages + failed_pages}")
-            
-            return all_links
-        else:
-            # Если не знаем, делаем запросы пакетами
-            # Сначала делаем несколько параллельных запросов
-            batch_size = concurrency * 2
-            max_pages = 1000  # Максимальное количество страниц на случай бесконечного цикла
-            page = 1
-            start = num_per_page
-            
-            while page < max_pages:
-                batch_tasks = []
-                for _ in range(batch_size):
-                    task = fetch_page_links(
-                        client, api_url, page, start, num_per_page,
-                        search_result_id, location_ids, viewport_ne, viewport_sw, post_headers
-                    )
-                    batch_tasks.append(task)
-                    page += 1
-                    start += num_per_page
-                
-                # Выполняем пакет запросов
-                results = await asyncio.gather(*batch_tasks, return_exceptions=True)
-                
+                    first_listings = []
+                    first_links = []
+                    all_links = []
+
+            # Если получили меньше результатов, чем запрашивали, значит это последняя страница.
+            # Считаем объявления, а не ссылки: объявление без navigationPageLink не укорачивает страницу
+            if len(first_listings) < num_per_page:
+                print("Получено меньше результатов на первой странице, завершаем.")
+                return all_links
+
+            # locationIds и viewport известны после первого запроса - тело для остальных страниц собираем один раз
+            page_template = _page_request_template(
+                search_result_id, location_ids, viewport_ne, viewport_sw, num_per_page
+            )
+
+            # Если знаем общее количество страниц, создаем задачи для всех под общим ограничителем
+            if total_pages:
+                print(f"\nЗапускаем параллельные запросы для {total_pages - 1} страниц...")
+
+                # Создаем задачи под общим ограничителем
+                async def fetch_with_admission(page_num):
+                    async with admission:
+                        try:
+                            return await fetch_page_links(
+                                client, api_url, page_num, page_num * num_per_page, num_per_page,
+                                search_result_id, location_ids, viewport_ne, viewport_sw, post_headers, limiter,
+                                base_json_data=page_template, admission=admission
+                            )
+                        except Exception as e:
+                            print(f"Ошибка на странице {page_num + 1}: {e}")
+                            raise
+
+                # Корутины создаются лениво: в работе держим не более concurrency * 2 задач,
+                # а результаты обрабатываем по мере завершения
+                page_coros = (fetch_with_admission(page_num) for page_num in range(1, total_pages))
+
+                # Страницы завершаются в произвольном порядке: складываем ссылки по номеру страницы
+                # и собираем итоговый список в порядке пагинации в конце. Фиксированные смещения
+                # (page_num * num_per_page) не подходят - страница может вернуть больше num_per_page
+                page_links = {}
+                collected_links = len(first_links)
+
                 # Обрабатываем результаты
-                batch_links = []
-                empty_pages = 0
-                for result in results:
+                successful_pages = 0
+                failed_pages = 0
+                async for result in iter_bounded(page_coros, concurrency * 2):
                     if isinstance(result, Exception):
-                        print(f"Ошибка в пакете: {result}")
-                        empty_pages += 1
+                        # Сообщение с номером страницы уже напечатано в fetch_with_admission
+                        failed_pages += 1
                         continue
-                    
-                    page_num, links = result
+
+                    page_num, links, _ = result
                     if links:
-                        batch_links.extend(links)
-                        all_links.extend(links)
-                        print(f"Страница {page_num + 1}: найдено {len(links)} ссылок. Всего: {len(all_links)}")
+                        page_links[page_num] = links
+                        if links_writer:
+                            links_writer.record(page_num, links)
+                        collected_links += len(links)
+                        successful_pages += 1
+                        if verbose or successful_pages % _PROGRESS_EVERY == 0:
+                            print(f"Обработано страниц: {successful_pages}/{total_pages - 1}, собрано ссылок: {collected_links}")
                     else:
-                        empty_pages += 1
-                
-                # Если все страницы в пакете пустые, завершаем
-                if empty_pages == len(results):
-                    print("Получены пустые ответы, завершаем.")
-                    break
-                
-                # Если получили меньше результатов, чем ожидали, возможно это конец
-                if len(batch_links) < batch_size * num_per_page * 0.5:  # Если получили меньше 50% ожидаемого
-                    print("Получено значительно меньше результатов, завершаем.")
-                    break
-            
-            print(f"\nИтого собрано ссылок: {len(all_links)}")
-            return all_links
+                        print(f"Предупреждение: страница {page_num + 1} вернула пустой результат")
+
+                # Складываем ссылки в порядке пагинации
+                for page_num in sorted(page_links):
+                    all_links.extend(page_links[page_num])
+
+                print(f"\nОбработано успешно: {successful_pages} страниц, ошибок: {failed_pages}")
+                print(f"Ожидалось страниц: {total_pages - 1}, обработано: {successful_pages + failed_pages}")
+                print(f"Итого собрано ссылок: {len(all_links)}")
+
+                # Проверяем, что мы получили все страницы
+                if successful_pages + failed_pages < total_pages - 1:
+                    print(f"ВНИМАНИЕ: Обработано меньше страниц, чем ожидалось!")
+                    print(f"Ожидалось: {total_pages - 1}, обработано: {successful_pages + failed_pages}")
+
+                return all_links
+            else:
+                # Если не знаем, страницы разбирают concurrency воркеров из общего счетчика:
+                # как только страница вернула меньше num_per_page объявлений, дальше выдача пуста
+                # и номера после нее воркеры уже не берут
+                max_pages = 1000  # Максимальное количество страниц на случай бесконечного цикла
+                next_page = itertools.count(1)
+                last_page = max_pages
+                page_links = {}
+                collected_links = len(first_links)
+
+                async def page_worker():
+                    nonlocal last_page, collected_links
+                    for page in next_page:
+                        if page >= last_page:
+                            return
+                        try:
+                            async with admission:
+                                page_num, links, listings_count = await fetch_page_links(
+                                    client, api_url, page, page * num_per_page, num_per_page,
+                                    search_result_id, location_ids, viewport_ne, viewport_sw, post_headers, limiter,
+                                    base_json_data=page_template, admission=admission
+                                )
+                        except Exception as e:
+                            # Сбой одной страницы не означает конец выдачи - идем дальше
+                            print(f"Ошибка на странице {page + 1}: {e}")
+                            continue
+                        if links:
+                            page_links[page_num] = links
+                            if links_writer:
+                                links_writer.record(page_num, links)
+                            collected_links += len(links)
+                            if verbose:
+                                print(f"Страница {page_num + 1}: найдено {len(links)} ссылок")
+                            elif len(page_links) % _PROGRESS_EVERY == 0:
+                                print(f"Обработано страниц: {len(page_links)}, собрано ссылок: {collected_links}")
+                        # Конец выдачи - успешный ответ с неполной страницей (считаем объявления, а не ссылки)
+                        if listings_count < num_per_page:
+                            last_page = min(last_page, page_num + 1)
+
+                await asyncio.gather(*(page_worker() for _ in range(concurrency)))
+                if last_page == max_pages:
+                    print(f"Достигнут лимит в {max_pages} страниц, завершаем.")
+                else:
+                    print("Получена неполная страница, завершаем.")
+
+                # Складываем ссылки в порядке пагинации
+                for page_num in sorted(page_links):
+                    all_links.extend(page_links[page_num])
+
+                print(f"\nИтого собрано ссылок: {len(all_links)}")
+                return all_links
+        finally:
+            watchdog.cancel()
 
 
 # Синхронная обертка для обратной совместимости
-def get_all_listing_links(location_url: str, concurrency: int = 10):
+def get_all_listing_links(
+    location_url: str,
+    concurrency: int = 10,
+    rate_limit: float = 10.0,
+    links_file: str | None = None,
+    verbose: bool = False
+):
     """
     Получает все ссылки на объявления (navigationPageLink) со всех страниц (асинхронная версия)
     
     Args:
         location_url: URL страницы, например 'https://www.compass.com/homes-for-sale/arizona/'
         concurrency: Количество одновременных запросов (по умолчанию 10)
+        rate_limit: Максимальная средняя частота запросов страниц в секунду (по умолчанию 10)
+        links_file: JSONL-файл для постраничной записи собранных ссылок (опционально)
+        verbose: Печатать результат каждой страницы (по умолчанию - периодическая сводка)
     
     Returns:
         list: Массив всех ссылок на объявления
     """
-    return asyncio.run(get_all_listing_links_async(location_url, concurrency))
+    return asyncio.run(get_all_listing_links_async(
+        location_url, concurrency, rate_limit, links_file, verbose=verbose
+    ))
 
 # ========== Парсинг объявлений из HTML ==========
 
-def extract_json_from_text(text: str, start_marker: str) -> str | None:
+# 'window.__INITIAL_DATA__' содержит '__INITIAL_DATA__', поэтому достаточно одного поиска
+_INITIAL_DATA_MARKER = b'__INITIAL_DATA__'
+
+# raw_decode разбирает JSON с начала строки и останавливается на закрывающей скобке,
+# игнорируя остаток страницы - поиск конца объекта идет в C-сканере json, а не в Python-цикле
+_JSON_DECODER = json.JSONDecoder()
+
+# Конец блока <script>: JSON внутри скрипта не может содержать его в открытом виде
+_SCRIPT_END = b'</script>'
+
+
+def _decode_initial_data(html: bytes) -> dict | None:
     """
-    Извлекает JSON объект из текста, начиная с маркера.
-    Использует подсчет скобок для правильного определения конца JSON.
+    Находит window.__INITIAL_DATA__ в теле ответа и разбирает JSON за один проход.
+    Маркер и начало объекта ищутся в байтах (bytes.find). Если объект - единственная
+    инструкция в скрипте, байты до '</script>' разбираются orjson без декодирования в str;
+    иначе (или без orjson) декодируется хвост начиная с '{' и разбирается raw_decode.
+    
+    Returns:
+        dict: разобранный объект или None, если маркера нет
+    
+    Raises:
+        json.JSONDecodeError: если после маркера находится некорректный JSON
     """
-    # Находим позицию маркера
-    pos = text.find(start_marker)
+    pos = html.find(_INITIAL_DATA_MARKER)
     if pos == -1:
         return None
     
     # Находим начало JSON объекта (первая '{' после '=')
-    pos = text.find('=', pos) + 1
+    pos = html.find(b'=', pos) + 1
     # Пропускаем пробелы
-    while pos < len(text) and text[pos] in ' \t\n\r':
+    while pos < len(html) and html[pos] in b' \t\n\r':
         pos += 1
     
-    if pos >= len(text) or text[pos] != '{':
+    if html[pos:pos + 1] != b'{':
         return None
     
-    # Начинаем с первой '{'
-    start_pos = pos
-    bracket_count = 0
-    in_string = False
-    escape_next = False
-    
-    # Проходим по тексту и считаем скобки
-    for i in range(start_pos, len(text)):
-        char = text[i]
-        
-        if escape_next:
-            escape_next = False
-            continue
-        
-        if char == '\\':
-            escape_next = True
-            continue
-        
-        if char == '"' and not escape_next:
-            in_string = not in_string
-            continue
-        
-        if not in_string:
-            if char == '{':
-                bracket_count += 1
-            elif char == '}':
-                bracket_count -= 1
-                if bracket_count == 0:
-                    # Нашли закрывающую скобку
-                    json_str = text[start_pos:i+1]
-                    return json_str
+    if orjson is not None:
+        end = html.find(_SCRIPT_END, pos)
+        json_bytes = html[pos:end if end != -1 else len(html)].rstrip().rstrip(b';').rstrip()
+        try:
+            return orjson.loads(json_bytes)
+        except orjson.JSONDecodeError:
+            # После объекта в скрипте есть другие инструкции - ищем его конец через raw_decode
+            pass
     
-    return None
+    json_text = html[pos:].decode('utf-8', errors='replace')
+    return _JSON_DECODER.raw_decode(json_text)[0]
 
 
-def extract_initial_data(html: str) -> dict | None:
+def extract_initial_data(html: bytes) -> dict | None:
     """
     Извлекает данные из window.__INITIAL_DATA__ в HTML
-    Использует алгоритм подсчета скобок для правильного извлечения больших JSON объектов
+    Принимает тело ответа в байтах (response.content), без декодирования всей страницы.
+    
+    Raises:
+        json.JSONDecodeError: если после маркера находится некорректный JSON
     """
-    try:
-        # Пробуем разные маркеры
-        markers = [
-            '__INITIAL_DATA__',
-            'window.__INITIAL_DATA__',
-        ]
-        
-        for marker in markers:
-            json_str = extract_json_from_text(html, marker)
-            if json_str:
-                try:
-                    data = json.loads(json_str)
-                    return data
-                except json.JSONDecodeError as e:
-                    # Пробуем следующий маркер
-                    continue
-        
-        return None
-        
-    except Exception as e:
-        print(f"Ошибка при извлечении __INITIAL_DATA__: {e}")
+    return _decode_initial_data(html)
+
+
+def _iter_detail_fields(listing_details: list) -> Iterator[dict]:
+    """Плоский обход полей listingDetails -> subCategories -> fields (не-словари пропускаются)"""
+    for detail_group in listing_details:
+        if type(detail_group) is dict:
+            for subcat in detail_group.get('subCategories') or ():
+                yield from subcat.get('fields') or ()
+
+
+def _find_field(listing_details: list, predicate) -> dict | None:
+    """Первое поле listingDetails с непустыми values, ключ которого (в нижнем регистре) подходит под predicate"""
+    for field in _iter_detail_fields(listing_details):
+        if predicate(field.get('key', '').lower()) and field.get('values'):
+            return field
+    return None
+
+
+def _clean_description(description: str | None) -> str | None:
+    """Пустое описание и шаблон формы запроса ('I would like more information about ...') -> None"""
+    if not description or description.startswith(_INQUIRY_PREFIX):
         return None
+    return description
+
+
+def _list_to_dict(items: list) -> dict:
+    """Список разделов -> словарь: ключ - 'name' раздела, иначе 'item_<индекс>'"""
+    return {
+        (item.get('name', f'item_{idx}') if isinstance(item, dict) else f'item_{idx}'): item
+        for idx, item in enumerate(items)
+    }
 
 
-def extract_listing_data(initial_data: dict, url: str = '') -> DbDTO | None:
+@lru_cache(maxsize=8192)
+def _normalize_url(url: str) -> str:
+    """
+    Приводит ссылку на медиа/профиль к абсолютной:
+    '//host/path' -> 'https://host/path', '/path' -> BASE_URL + '/path', остальные без изменений.
+    Результат кэшируется: ссылки на CDN и профили агентов повторяются между объявлениями
+    """
+    prefix = url[:2]
+    if prefix == '//':
+        return 'https:' + url
+    if prefix[:1] == '/':
+        return BASE_URL + url
+    return url
+
+
+def extract_listing_data(initial_data: dict, url: str = '', fields: frozenset[str] | None = None) -> DbDTO | None:
     """
     Извлекает нужные поля из window.__INITIAL_DATA__ и возвращает DbDTO объект
+    
+    Args:
+        fields: Имена полей DbDTO, которые нужны вызывающему (опционально). Дорогие разделы
+                (size, lot_size, listing_details, photos/brochure_pdf, agents), которых нет
+                в fields, не разбираются и остаются None. По умолчанию разбирается все.
     """
     try:
         # Находим данные листинга
-        listing = None
-        if 'props' in initial_data and 'listingRelation' in initial_data['props']:
-            listing = initial_data['props']['listingRelation'].get('listing')
+        listing_relation = (initial_data.get('props') or {}).get('listingRelation')
+        listing = listing_relation.get('listing') if listing_relation else None
         
         if not listing:
             return None
         
-        # Исправляем URL (убираем двойной слэш)
-        fixed_url = url.replace(f'{BASE_URL}//', f'{BASE_URL}/')
+        # Вложенные объекты, к которым обращаемся многократно, достаем один раз
+        price_data = listing.get('price') or {}
+        detailed_info = listing.get('detailedInfo') or {}
+        listing_details = detailed_info.get('listingDetails')
+        key_details = detailed_info.get('keyDetails')
+        deal_info = listing.get('dealInfo') or {}
+        date_data = listing.get('date') or {}
+        media_list = listing.get('media') or ()
+        tx_hist = listing.get('transactionHistory') or ()
+        contacts = listing.get('fullContacts') or ()
+        
+        # Частичный разбор: пропускаем разделы, которые не запрошены
+        want_size = want_lot_size = want_details = True
+        if fields is not None:
+            want_size = 'size' in fields
+            want_lot_size = 'lot_size' in fields
+            want_details = 'listing_details' in fields
+            if 'photos' not in fields and 'brochure_pdf' not in fields:
+                media_list = ()
+            if 'agents' not in fields:
+                contacts = ()
+        
+        # Исправляем URL (убираем двойной слэш после домена). Ссылки из _extract_nav_links
+        # уже собираются без него, поэтому обычно это одна проверка префикса без копирования строки
+        fixed_url = url[:len(BASE_URL)] + url[len(BASE_URL) + 1:] if url.startswith(f'{BASE_URL}//') else url
         
         # Извлекаем базовые идентификаторы
         listing_id = listing.get('listingIdSHA', '') or listing.get('compassPropertyId', '') or listing.get('feedListingId', '')
@@ -692,32 +1295,34 @@ def extract_listing_data(initial_data: dict, url: str = '') -> DbDTO | None:
         listing_id = str(listing_id) if listing_id else 'unknown'
         
         # Адрес и локация
-        location = listing.get('location', {})
+        location = listing.get('location') or {}
+        # Компоненты адреса нужны и для сборки адреса, и для полей DbDTO - читаем их один раз
+        building_number = location.get('streetNumber')
+        street_name = location.get('street')
+        unit_number = location.get('unitNumber')
+        city = location.get('city')
+        state = location.get('state')
+        zipcode = location.get('zipCode')
         address = location.get('prettyAddress', '')
         if not address:
-            # Формируем адрес из компонентов
-            parts = []
-            if location.get('streetNumber'):
-                parts.append(location['streetNumber'])
-            if location.get('street'):
-                parts.append(location['street'])
-            if location.get('streetType'):
-                parts.append(location['streetType'])
-            if location.get('unitNumber'):
-                parts.append(f"{location.get('unitType', 'Unit')} {location['unitNumber']}")
-            if parts:
-                address = ', '.join(parts)
-            if location.get('city'):
-                address += f", {location['city']}"
-            if location.get('state'):
-                address += f" {location['state']}"
-            if location.get('zipCode'):
-                address += f" {location['zipCode']}"
+            # Формируем адрес из компонентов одной склейкой
+            parts = [part for part in (building_number, street_name, location.get('streetType')) if part]
+            if unit_number:
+                parts.append(f"{location.get('unitType', 'Unit')} {unit_number}")
+            address = ''.join((
+                ', '.join(parts),
+                f", {city}" if city else '',
+                f" {state}" if state else '',
+                f" {zipcode}" if zipcode else '',
+            ))
         
         # Координаты
+        # Нулевая широта/долгота - реальные координаты, поэтому проверяем на None, а не на истинность
         coordinates = None
-        if location.get('latitude') and location.get('longitude'):
-            coordinates = f"{location['latitude']},{location['longitude']}"
+        latitude = location.get('latitude')
+        longitude = location.get('longitude')
+        if latitude is not None and longitude is not None:
+            coordinates = f"{latitude},{longitude}"
         
         # Тип объявления
         listing_type_num = listing.get('listingType', 0)
@@ -725,7 +1330,8 @@ def extract_listing_data(initial_data: dict, url: str = '') -> DbDTO | None:
         
         # Статус
         listing_status = listing.get('localizedStatus', '')
-        if not listing_status and 'status' in listing:
+        status = listing.get('status')
+        if not listing_status and status is not None:
             status_map = {
                 0: 'Active',
                 9: 'Active',
@@ -734,13 +1340,12 @@ def extract_listing_data(initial_data: dict, url: str = '') -> DbDTO | None:
                 10: 'Sold',
                 8: 'Contract Signed',
             }
-            listing_status = status_map.get(listing['status'], f"Status {listing['status']}")
+            listing_status = status_map.get(status, f"Status {status}")
         
         # Цена
         sale_price = None
         lease_price = None
-        if 'price' in listing:
-            price_data = listing['price']
+        if price_data:
             price_formatted = price_data.get('formatted', '')
             if listing_type_num == 1:
                 lease_price = price_formatted
@@ -750,243 +1355,144 @@ def extract_listing_data(initial_data: dict, url: str = '') -> DbDTO | None:
         # Площадь
         square_feet = 0
         size_str = None
-        if 'size' in listing:
-            size_data = listing['size']
+        size_data = listing.get('size') if want_size else None
+        if size_data is not None:
             square_feet = size_data.get('squareFeet', 0)
             if square_feet:
                 size_str = f"{square_feet:,} sqft"
         
         # Если не нашли в size, проверяем в detailedInfo
-        if not square_feet and 'detailedInfo' in listing:
-            detailed_info = listing['detailedInfo']
-            if 'listingDetails' in detailed_info:
-                for detail_group in detailed_info['listingDetails']:
-                    if 'subCategories' in detail_group:
-                        for subcat in detail_group['subCategories']:
-                            if 'fields' in subcat:
-                                for field in subcat['fields']:
-                                    key = field.get('key', '').lower()
-                                    if 'sqft' in key or 'square' in key or 'sq ft' in key:
-                                        values = field.get('values', [])
-                                        if values:
-                                            try:
-                                                value_str = str(values[0]).replace(',', '').replace(' ', '')
-                                                square_feet = float(value_str)
-                                                size_str = f"{int(square_feet):,} sqft"
-                                                break
-                                            except (ValueError, TypeError):
-                                                pass
+        if want_size and not square_feet and listing_details:
+            for field in _iter_detail_fields(listing_details):
+                key = field.get('key', '').lower()
+                # Точные ключи проверяем одним поиском в set, подстроки - только если не совпало
+                if key in _SQFT_KEYS or 'sqft' in key or 'square' in key or 'sq ft' in key:
+                    values = field.get('values', [])
+                    if values:
+                        try:
+                            value_str = str(values[0]).replace(',', '').replace(' ', '')
+                            square_feet = float(value_str)
+                            size_str = f"{int(square_feet):,} sqft"
+                        except (ValueError, TypeError):
+                            pass
+                        if square_feet:
+                            break
         
         # Lot size
         lot_size_str = None
-        if 'detailedInfo' in listing:
-            detailed_info = listing['detailedInfo']
-            if 'keyDetails' in detailed_info:
-                for key_detail in detailed_info['keyDetails']:
-                    key = key_detail.get('key', '').lower()
-                    if 'lot size' in key or 'lot' in key:
+        if want_lot_size:
+            if key_details:
+                for key_detail in key_details:
+                    # 'lot size' тоже содержит 'lot' - достаточно одной проверки
+                    if 'lot' in key_detail.get('key', '').lower():
                         value = key_detail.get('value', '')
                         if value and value != '-':
                             lot_size_str = value
                             break
             
             # Если не нашли в keyDetails, проверяем в listingDetails
-            if not lot_size_str and 'listingDetails' in detailed_info:
-                for detail_group in detailed_info['listingDetails']:
-                    if 'subCategories' in detail_group:
-                        for subcat in detail_group['subCategories']:
-                            if 'fields' in subcat:
-                                for field in subcat['fields']:
-                                    key = field.get('key', '').lower()
-                                    if 'lot size' in key or 'lot' in key:
-                                        values = field.get('values', [])
-                                        if values:
-                                            lot_size_str = str(values[0])
-                                            break
-                                if lot_size_str:
-                                    break
-                            if lot_size_str:
-                                break
-                    if lot_size_str:
-                        break
+            if not lot_size_str and listing_details:
+                lot_field = _find_field(listing_details, lambda key: 'lot' in key)
+                if lot_field:
+                    lot_size_str = str(lot_field['values'][0])
         
         # Описание
-        description = None
-        if 'description' in listing and listing['description']:
-            description = listing['description']
-            if description.startswith('I would like more information about'):
-                description = None
-        
-        if not description and 'dealInfo' in listing:
-            deal_info = listing['dealInfo']
-            if 'description' in deal_info and deal_info['description']:
-                description = deal_info['description']
-                if description.startswith('I would like more information about'):
-                    description = None
-        
-        if not description and 'detailedInfo' in listing:
-            detailed_info = listing['detailedInfo']
-            if 'description' in detailed_info and detailed_info['description']:
-                description = detailed_info['description']
+        description = (
+            _clean_description(listing.get('description'))
+            or _clean_description(deal_info.get('description'))
+            or detailed_info.get('description')
+            or None
+        )
         
         # Listing details - преобразуем список в словарь, если нужно
         listing_details_dict = None
-        if 'detailedInfo' in listing:
-            detailed_info = listing['detailedInfo']
-            if 'listingDetails' in detailed_info:
-                details_data = detailed_info['listingDetails']
-                # Если это список, преобразуем в словарь
-                if isinstance(details_data, list):
-                    # Создаем словарь, используя индекс или имя как ключ
-                    listing_details_dict = {}
-                    for idx, item in enumerate(details_data):
-                        if isinstance(item, dict):
-                            # Используем 'name' как ключ, если есть, иначе индекс
-                            key = item.get('name', f'item_{idx}')
-                            listing_details_dict[key] = item
-                        else:
-                            listing_details_dict[f'item_{idx}'] = item
-                elif isinstance(details_data, dict):
-                    listing_details_dict = details_data
-            elif 'keyDetails' in detailed_info:
-                key_details_data = detailed_info['keyDetails']
-                # Если это список, преобразуем в словарь
-                if isinstance(key_details_data, list):
-                    listing_details_dict = {}
-                    for idx, item in enumerate(key_details_data):
-                        if isinstance(item, dict):
-                            key = item.get('name', f'item_{idx}')
-                            listing_details_dict[key] = item
-                        else:
-                            listing_details_dict[f'item_{idx}'] = item
-                elif isinstance(key_details_data, dict):
-                    listing_details_dict = key_details_data
+        if want_details:
+            details_data = listing_details if listing_details is not None else key_details
+            if isinstance(details_data, list):
+                listing_details_dict = _list_to_dict(details_data)
+            elif isinstance(details_data, dict):
+                listing_details_dict = details_data
         
-        # Фото - только URL строки
+        # Фото (только URL строки) и Brochure PDF - за один проход по media
         photos_list = []
-        if 'media' in listing:
-            for media in listing['media']:
-                if media.get('category', 0) == 0 and 'originalUrl' in media:
-                    photo_url = media['originalUrl']
-                    if photo_url.startswith('//'):
-                        photo_url = 'https:' + photo_url
-                    elif photo_url.startswith('/'):
-                        photo_url = BASE_URL + photo_url
-                    photos_list.append(photo_url)
-        
-        # Brochure PDF
         brochure_pdf = None
-        if 'media' in listing:
-            for media in listing['media']:
-                original_url = media.get('originalUrl', '')
-                if original_url and original_url.lower().endswith('.pdf'):
-                    brochure_pdf = original_url
-                    if brochure_pdf.startswith('//'):
-                        brochure_pdf = 'https:' + brochure_pdf
-                    elif brochure_pdf.startswith('/'):
-                        brochure_pdf = BASE_URL + brochure_pdf
-                    break
+        for media in media_list:
+            original_url = media.get('originalUrl')
+            if not original_url:
+                continue
+            if media.get('category', 0) == 0:
+                photos_list.append(_normalize_url(original_url))
+            if brochure_pdf is None and original_url[-4:].lower() == _PDF_SUFFIX:
+                brochure_pdf = _normalize_url(original_url)
         
         # MLS номер
         mls_number = None
-        if 'transactionHistory' in listing and listing['transactionHistory']:
-            latest_transaction = listing['transactionHistory'][0]
-            if 'source' in latest_transaction:
-                source = latest_transaction['source']
-                if 'externalSourceId' in source:
-                    mls_number = source.get('externalSourceId', '')
+        if tx_hist:
+            source = tx_hist[0].get('source') or {}
+            mls_number = source.get('externalSourceId')
         
         # Агенты - преобразуем в AgentData
         agents_list = []
-        if 'fullContacts' in listing:
-            for contact in listing['fullContacts']:
-                profile_url = contact.get('websiteURL', '')
-                if profile_url.startswith('/'):
-                    profile_url = BASE_URL + profile_url
-                
-                # Обрабатываем email - только если он валидный
-                email = contact.get('email')
-                if not email or email.strip() == '':
-                    email = None
-                
-                # Обрабатываем photo_url
-                photo_url = contact.get('profileImageURL')
-                if photo_url:
-                    if photo_url.startswith('//'):
-                        photo_url = 'https:' + photo_url
-                    elif photo_url.startswith('/'):
-                        photo_url = BASE_URL + photo_url
-                
-                agent = AgentData(
-                    name=contact.get('contactName'),
-                    license=contact.get('licenseNum'),
-                    phone_primary=contact.get('phone'),
-                    email=email,
-                    photo_url=photo_url,
-                    office_name=contact.get('company'),
-                )
-                agents_list.append(agent)
+        for contact in contacts:
+            # Обрабатываем email - только если он валидный
+            email = contact.get('email')
+            if not email or email.strip() == '':
+                email = None
+            
+            # Обрабатываем photo_url
+            photo_url = contact.get('profileImageURL')
+            if photo_url:
+                photo_url = _normalize_url(photo_url)
+            
+            agent = AgentData(
+                **{field: contact.get(key) for field, key in _AGENT_FIELDS},
+                email=email,
+                photo_url=photo_url,
+            )
+            agents_list.append(agent)
         
         # Property type
         property_type = None
-        if 'detailedInfo' in listing:
-            detailed_info = listing['detailedInfo']
-            if 'propertyType' in detailed_info:
-                prop_type = detailed_info['propertyType']
-                if 'masterType' in prop_type and 'GLOBAL' in prop_type['masterType']:
-                    types = prop_type['masterType']['GLOBAL']
-                    if types:
-                        property_type = types[0]
+        prop_type = detailed_info.get('propertyType') or {}
+        types = (prop_type.get('masterType') or {}).get('GLOBAL')
+        if types:
+            property_type = types[0]
         
-        # Year built
+        # Year built и Days on Market - за один проход по keyDetails
         year_built = None
-        if 'detailedInfo' in listing:
-            detailed_info = listing['detailedInfo']
-            if 'keyDetails' in detailed_info:
-                for key_detail in detailed_info['keyDetails']:
-                    if key_detail.get('key') == 'Year Built':
-                        value = key_detail.get('value', '')
-                        if value and value != '-':
-                            try:
-                                year_built = int(value)
-                            except (ValueError, TypeError):
-                                pass
+        days_on_market = None
+        for key_detail in key_details or ():
+            key = key_detail.get('key', '')
+            if key == 'Year Built':
+                value = key_detail.get('value', '')
+                if value and value != '-':
+                    try:
+                        year_built = int(value)
+                    except (ValueError, TypeError):
+                        pass
+            elif 'Days on Market' in key:
+                days_on_market = key_detail.get('value', '')
         
         # Даты
         listing_date_obj = None
         last_updated_obj = None
-        days_on_market = None
-        
-        if 'date' in listing:
-            date_data = listing['date']
-            # updated может быть timestamp в миллисекундах
-            if 'updated' in date_data:
-                updated_ts = date_data['updated']
-                if updated_ts:
-                    try:
-                        # Конвертируем из миллисекунд в секунды
-                        dt = datetime.fromtimestamp(updated_ts / 1000)
-                        last_updated_obj = dt.date()
-                    except (ValueError, TypeError, OSError):
-                        pass
-            # listed может быть timestamp в миллисекундах
-            if 'listed' in date_data:
-                listed_ts = date_data['listed']
-                if listed_ts:
-                    try:
-                        # Конвертируем из миллисекунд в секунды
-                        dt = datetime.fromtimestamp(listed_ts / 1000)
-                        listing_date_obj = dt.date()
-                    except (ValueError, TypeError, OSError):
-                        pass
         
-        # Days on Market
-        if 'detailedInfo' in listing:
-            detailed_info = listing['detailedInfo']
-            if 'keyDetails' in detailed_info:
-                for key_detail in detailed_info['keyDetails']:
-                    if 'Days on Market' in key_detail.get('key', ''):
-                        days_on_market = key_detail.get('value', '')
+        # updated может быть timestamp в миллисекундах
+        updated_ts = date_data.get('updated')
+        if updated_ts:
+            try:
+                # Конвертируем из миллисекунд в секунды, время суток не нужно
+                last_updated_obj = date.fromtimestamp(updated_ts // 1000)
+            except (ValueError, TypeError, OSError):
+                pass
+        # listed может быть timestamp в миллисекундах
+        listed_ts = date_data.get('listed')
+        if listed_ts:
+            try:
+                # Конвертируем из миллисекунд в секунды, время суток не нужно
+                listing_date_obj = date.fromtimestamp(listed_ts // 1000)
+            except (ValueError, TypeError, OSError):
+                pass
         
         # Если days_on_market равно "-", проверяем daysOnMarket в listing
         if days_on_market == "-":
@@ -1007,12 +1513,12 @@ def extract_listing_data(initial_data: dict, url: str = '') -> DbDTO | None:
             listing_status=listing_status,
             address=address if address else "Address not found",
             coordinates=coordinates,
-            building_number=location.get('streetNumber'),
-            street_name=location.get('street'),
-            unit_number=location.get('unitNumber'),
-            city=location.get('city'),
-            state=location.get('state'),
-            zipcode=location.get('zipCode'),
+            building_number=building_number,
+            street_name=street_name,
+            unit_number=unit_number,
+            city=city,
+            state=state,
+            zipcode=zipcode,
             sale_price=sale_price,
             lease_price=lease_price,
             size=size_str,
@@ -1032,38 +1538,253 @@ def extract_listing_data(initial_data: dict, url: str = '') -> DbDTO | None:
         
         return dto
         
-    except Exception as e:
-        print(f"Ошибка при извлечении данных листинга: {e}")
-        import traceback
-        traceback.print_exc()
+    # Ошибки формы данных (неожиданные типы и структура JSON, ValidationError pydantic -
+    # подкласс ValueError) означают пропуск объявления; остальное - баг, его ловит parse_listing
+    except (KeyError, IndexError, TypeError, ValueError, AttributeError):
+        logger.exception("Ошибка при извлечении данных листинга %s", url)
         return None
 
 
-async def parse_listing(client: httpx.AsyncClient, url: str, semaphore: asyncio.Semaphore) -> DbDTO | None:
+def _page_cache_path(cache_dir: str, url: str) -> str:
+    """
+    Путь к файлу с закешированной страницей (имя - sha1 от URL).
+    Хранится только участок с __INITIAL_DATA__ (см. _read_initial_data_section)
+    """
+    return os.path.join(cache_dir, hashlib.sha1(url.encode('utf-8')).hexdigest() + '.html')
+
+
+def _read_cache_file(path: str, ttl: float | None = None) -> bytes | None:
+    """Возвращает содержимое файла кеша, если он есть и (при заданном ttl) не старше ttl секунд"""
+    try:
+        if ttl is not None and time.time() - os.path.getmtime(path) > ttl:
+            return None
+        with open(path, 'rb') as f:
+            return f.read()
+    except OSError:
+        return None
+
+
+def _write_cache_file(path: str, content: bytes) -> None:
+    """Атомарно сохраняет файл кеша (через временный файл и os.replace)"""
+    tmp_path = f'{path}.{os.getpid()}.tmp'
+    try:
+        with open(tmp_path, 'wb') as f:
+            f.write(content)
+        os.replace(tmp_path, path)
+    except OSError as e:
+        logger.warning("Не удалось сохранить файл кеша %s: %s", path, e)
+
+
+async def _read_initial_data_section(response: httpx.Response, chunk_size: int = 65536) -> bytes:
+    """
+    Читает потоковый ответ и оставляет только участок страницы от маркера __INITIAL_DATA__
+    до закрывающего </script>: преамбула HTML и остаток страницы после скрипта в памяти не копятся.
+    По HTTP/2 остаток страницы не загружается - закрытие ответа отменяет только этот поток.
+    По HTTP/1.1 недочитанное тело заставило бы httpx закрыть соединение вместо возврата в пул,
+    поэтому остаток дочитывается без сохранения. Если маркера нет - возвращает b''
+    """
+    buf = bytearray()
+    found = False
+    scan_from = 0
+    chunks = response.aiter_bytes(chunk_size)
+    async for chunk in chunks:
+        buf += chunk
+        if not found:
+            pos = buf.find(_INITIAL_DATA_MARKER)
+            if pos == -1:
+                # Оставляем хвост: маркер может оказаться на границе чанков
+                del buf[:-(len(_INITIAL_DATA_MARKER) - 1)]
+                continue
+            del buf[:pos]
+            found = True
+        end = buf.find(_SCRIPT_END, scan_from)
+        if end != -1:
+            del buf[end:]
+            break
+        scan_from = max(0, len(buf) - len(_SCRIPT_END) + 1)
+    if response.http_version != 'HTTP/2':
+        async for _ in chunks:
+            pass
+    return bytes(buf) if found else b''
+
+
+def _cache_validators(path: str) -> dict:
+    """Заголовки условного запроса из сохраненных рядом со страницей ETag/Last-Modified"""
+    raw = _read_cache_file(path + '.meta')
+    if raw is None:
+        return {}
+    try:
+        meta = _json_loads(raw)
+    except json.JSONDecodeError:
+        return {}
+    headers = {}
+    if meta.get('etag'):
+        headers['If-None-Match'] = meta['etag']
+    if meta.get('last_modified'):
+        headers['If-Modified-Since'] = meta['last_modified']
+    return headers
+
+
+def _write_cache_validators(path: str, response: httpx.Response) -> None:
+    """Сохраняет ETag/Last-Modified ответа рядом с закешированной страницей"""
+    etag = response.headers.get('ETag')
+    last_modified = response.headers.get('Last-Modified')
+    if etag or last_modified:
+        meta = {'etag': etag, 'last_modified': last_modified}
+        _write_cache_file(path + '.meta', json.dumps(meta).encode('utf-8'))
+
+
+def parse_listing_html(
+    html: bytes,
+    url: str,
+    parsed_cache_dir: str | None = None,
+    fields: frozenset[str] | None = None
+) -> DbDTO | None:
+    """
+    Извлекает __INITIAL_DATA__ из HTML страницы объявления и сразу преобразует его в DbDTO.
+    Функция верхнего уровня (picklable), чтобы её можно было выполнять в ProcessPoolExecutor:
+    между процессами передаются только байты страницы и готовый DbDTO, а не весь словарь.
+    
+    Args:
+        parsed_cache_dir: Каталог кеша готовых DbDTO (опционально). Ключ - хеш исходных байт
+                          страницы (участка с __INITIAL_DATA__) и URL: для неизменившегося объявления
+                          DbDTO читается с диска до разбора JSON и обхода словаря.
+        fields: Набор нужных полей DbDTO для частичного разбора (см. extract_listing_data)
+    """
+    cache_path = None
+    if parsed_cache_dir:
+        # Хешируем байты до json-разбора: при попадании в кеш JSON страницы не декодируется вовсе
+        digest = hashlib.blake2b(html, digest_size=16)
+        digest.update(url.encode('utf-8'))
+        if fields is not None:
+            # Частичный DbDTO не должен попасть в ответ на полный запрос
+            digest.update(','.join(sorted(fields)).encode('utf-8'))
+        cache_path = os.path.join(parsed_cache_dir, digest.hexdigest() + '.json')
+        cached = _read_cache_file(cache_path)
+        if cached is not None:
+            try:
+                return DbDTO.model_validate_json(cached)
+            except ValueError:
+                # Поврежденный файл или изменившаяся схема - разбираем заново
+                pass
+    
+    try:
+        initial_data = _decode_initial_data(html)
+    except json.JSONDecodeError as e:
+        logger.warning("Некорректный JSON в __INITIAL_DATA__ на %s: %s", url, e)
+        return None
+    
+    if not initial_data:
+        logger.warning("Не удалось извлечь __INITIAL_DATA__ из %s", url)
+        return None
+    
+    dto = extract_listing_data(initial_data, url, fields)
+    if not dto:
+        logger.warning("Не удалось извлечь данные листинга из %s", url)
+    elif cache_path:
+        _write_cache_file(cache_path, dto.model_dump_json(exclude_none=True).encode('utf-8'))
+    return dto
+
+
+_PARSE_POOL: ProcessPoolExecutor | None = None
+
+
+def _get_parse_pool() -> ProcessPoolExecutor:
+    """
+    Возвращает общий пул процессов для разбора HTML, создавая его при первом вызове.
+    Пул живет до конца работы скрипта и переиспользуется между location'ами,
+    одно ядро оставляем event loop'у.
+    
+    Пул создается уже внутри работающего event loop, когда у процесса есть потоки
+    резолвера и executor'а: fork скопировал бы их захваченные блокировки и мог бы
+    повесить дочерний процесс, поэтому процессы запускаются через spawn
+    """
+    global _PARSE_POOL
+    if _PARSE_POOL is None:
+        _PARSE_POOL = ProcessPoolExecutor(
+            max_workers=max(2, (os.cpu_count() or 1) - 1),
+            mp_context=multiprocessing.get_context('spawn'),
+        )
+        atexit.register(_PARSE_POOL.shutdown)
+    return _PARSE_POOL
+
+
+async def parse_listing(
+    client: httpx.AsyncClient,
+    url: str,
+    admission: AdmissionController,
+    executor: Executor | None = None,
+    cache_dir: str | None = None,
+    cache_ttl: float | None = 86400,
+    fields: frozenset[str] | None = None,
+    limiter: RateLimiter | None = None
+) -> DbDTO | None:
     """
     Парсит одно объявление по URL и возвращает DbDTO объект
+    
+    Args:
+        admission: Ограничитель одновременных запросов (AdmissionController)
+        executor: Пул, в котором выполняется CPU-bound разбор HTML.
+                  Если не передан, разбор выполняется в текущем потоке.
+        cache_dir: Каталог дискового кеша HTML страниц (опционально).
+                   Страница не старше cache_ttl секунд берется с диска без запроса,
+                   более старая перепроверяется условным запросом (ETag/Last-Modified),
+                   готовые DbDTO кешируются в подкаталоге 'parsed'.
+        cache_ttl: Срок (в секундах), в течение которого копия из кеша используется без запроса.
+                   None - копия не перепроверяется никогда
+        fields: Набор нужных полей DbDTO для частичного разбора (см. extract_listing_data)
+        limiter: Общий ограничитель частоты запросов к compass (опционально), ждем токен перед каждой попыткой
     """
-    async with semaphore:
+    cache_path = _page_cache_path(cache_dir, url) if cache_dir else None
+    parsed_cache_dir = os.path.join(cache_dir, 'parsed') if cache_dir else None
+    content = _read_cache_file(cache_path, cache_ttl) if cache_path else None
+    if content is not None:
+        return await _parse_listing_content(content, url, executor, parsed_cache_dir, fields)
+    
+    # Копия в кеше устарела (или ее нет): если у нее сохранены ETag/Last-Modified,
+    # делаем условный запрос - на 304 сервер не передает страницу повторно
+    conditional_headers = _cache_validators(cache_path) if cache_path else {}
+    
+    async with admission:
         try:
-            headers = {
-                'User-Agent': UserAgent().random,
-                'Accept': 'text/html,application/xhtml+xml,application/xml;q=0.9,*/*;q=0.8',
-                'Accept-Language': 'en-US,en;q=0.5',
-            }
+            # Accept/Accept-Language и таймаут заданы на клиенте (см. parse_listings_async)
+            headers = {'User-Agent': get_new_user_agent(), **conditional_headers}
             
-            # Пытаемся выполнить запрос с retry при 403
-            max_retries = 3
+            # Пытаемся выполнить запрос с retry: при 403 меняем User-Agent,
+            # при 429/5xx и сетевых ошибках ждем с экспоненциальной задержкой
+            max_retries = 4
             response = None
             for attempt in range(max_retries):
-                response = await client.get(url, headers=headers, timeout=30.0, follow_redirects=True)
+                is_last = attempt == max_retries - 1
+                if limiter is not None:
+                    await limiter.acquire()
+                try:
+                    # Тело читается потоком (см. _read_initial_data_section), поэтому stream=True
+                    request = client.build_request('GET', url, headers=headers)
+                    response = await client.send(request, stream=True, follow_redirects=True)
+                except httpx.TransportError as e:
+                    admission.report_error()
+                    if is_last:
+                        raise
+                    delay = _retry_delay(attempt)
+                    logger.info("Сетевая ошибка на %s (%s), повтор через %.1f с", url, e, delay)
+                    await asyncio.sleep(delay)
+                    continue
+                
+                admission.report(response.status_code)
                 if response.status_code == 200:
                     break
-                elif response.status_code == 403:
-                    if attempt < max_retries - 1:
-                        headers = update_user_agent_in_headers(headers)
-                    else:
-                        response.raise_for_status()
-                        break
+                elif response.status_code == 304 and conditional_headers:
+                    break
+                
+                # Тело неуспешного ответа не нужно - освобождаем соединение
+                await response.aclose()
+                if response.status_code == 403 and not is_last:
+                    headers = update_user_agent_in_headers(headers)
+                elif response.status_code in _RETRY_STATUSES and not is_last:
+                    delay = _retry_delay(attempt, response)
+                    logger.info("Ответ %s на %s, повтор через %.1f с", response.status_code, url, delay)
+                    await asyncio.sleep(delay)
                 else:
                     response.raise_for_status()
                     break
@@ -1071,69 +1792,302 @@ async def parse_listing(client: httpx.AsyncClient, url: str, semaphore: asyncio.
             if not response:
                 raise Exception("Не удалось получить ответ от сервера")
             
-            response.raise_for_status()
-            
-            html = response.text
-            initial_data = extract_initial_data(html)
-            
-            if not initial_data:
-                print(f"⚠ Не удалось извлечь __INITIAL_DATA__ из {url}")
-                return None
+            try:
+                if response.status_code == 304:
+                    # Страница не изменилась - берем копию из кеша и продлеваем ее срок
+                    content = _read_cache_file(cache_path)
+                    if content is None:
+                        raise Exception("Ответ 304, но копии страницы в кеше нет")
+                    os.utime(cache_path)
+                else:
+                    response.raise_for_status()
+                    content = await _read_initial_data_section(response)
+                    # Пустой участок - на странице нет __INITIAL_DATA__ (например, проверка на бота):
+                    # в кеш не пишем, иначе объявление не перезапрашивалось бы до истечения cache_ttl
+                    if cache_path and content:
+                        _write_cache_file(cache_path, content)
+                        _write_cache_validators(cache_path, response)
+            finally:
+                await response.aclose()
             
-            dto = extract_listing_data(initial_data, url)
-            if dto:
-                return dto
-            else:
-                print(f"⚠ Не удалось извлечь данные листинга из {url}")
-                return None
+            return await _parse_listing_content(content, url, executor, parsed_cache_dir, fields)
                 
         except Exception as e:
-            print(f"❌ Ошибка при парсинге {url}: {e}")
+            logger.warning("Ошибка при парсинге %s: %s", url, e)
             return None
 
 
-async def parse_listings_async(listing_urls: list[str], concurrency: int = 10, limit: int = None) -> list[DbDTO]:
+async def _parse_listing_content(
+    content: bytes,
+    url: str,
+    executor: Executor | None,
+    parsed_cache_dir: str | None = None,
+    fields: frozenset[str] | None = None
+) -> DbDTO | None:
+    """Разбирает HTML объявления в текущем потоке или в executor"""
+    try:
+        if executor is None:
+            return parse_listing_html(content, url, parsed_cache_dir, fields)
+        
+        # Разбор HTML нагружает CPU - выносим его в пул, чтобы не блокировать event loop
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(executor, parse_listing_html, content, url, parsed_cache_dir, fields)
+    except Exception as e:
+        logger.warning("Ошибка при парсинге %s: %s", url, e)
+        return None
+
+
+async def iter_listings_async(
+    listing_urls: list[str],
+    concurrency: int = 10,
+    limit: int = None,
+    cache_dir: str | None = None,
+    fields: frozenset[str] | None = None,
+    rate_limit: float | None = None,
+    cache_ttl: float | None = 86400
+) -> AsyncIterator[DbDTO]:
     """
-    Асинхронно парсит список объявлений
+    Асинхронно парсит список объявлений пулом воркеров и отдает DbDTO по мере готовности:
+    результаты не ждут самых медленных страниц и не накапливаются в памяти
     
     Args:
         listing_urls: Список URL объявлений
         concurrency: Количество одновременных запросов
         limit: Ограничение количества объявлений для обработки (опционально)
+        cache_dir: Каталог дискового кеша HTML страниц (опционально, для повторных прогонов)
+        fields: Набор нужных полей DbDTO - остальные дорогие разделы не разбираются (опционально)
+        rate_limit: Максимальная средняя частота запросов в секунду (опционально, например 5.0 = 300 в минуту).
+                    Запросы из кеша без обращения к сайту токены не расходуют.
+        cache_ttl: Срок свежести копии в кеше в секундах (см. parse_listing); 0 - перепроверять
+                   каждую страницу условным запросом, None - не перепроверять никогда
     
-    Returns:
-        list: Список DbDTO объектов с данными объявлений
+    Yields:
+        DbDTO: данные очередного успешно разобранного объявления
     """
     if limit:
         listing_urls = listing_urls[:limit]
     
     print(f"\nНачинаем парсинг {len(listing_urls)} объявлений...")
     
-    semaphore = asyncio.Semaphore(concurrency)
-    results = []
+    if cache_dir:
+        os.makedirs(os.path.join(cache_dir, 'parsed'), exist_ok=True)
     
-    async with httpx.AsyncClient() as client:
-        tasks = [parse_listing(client, url, semaphore) for url in listing_urls]
-        results = await asyncio.gather(*tasks, return_exceptions=True)
+    # Лимит одновременных запросов подстраивается watchdog'ом по ответам 429/503,
+    # а token bucket сглаживает частоту запросов, чтобы всплески не приводили к 403/429
+    admission = AdmissionController(concurrency)
+    limiter = RateLimiter(rate_limit, burst=concurrency) if rate_limit else None
+    parsed_count = 0
     
-    # Фильтруем успешные результаты
-    parsed_listings = []
-    for i, result in enumerate(results):
-        if isinstance(result, Exception):
-            print(f"❌ Ошибка при обработке объявления {i+1}: {result}")
-        elif result:
-            parsed_listings.append(result)
-            print(f"✓ Обработано объявление {len(parsed_listings)}/{len(listing_urls)}: {result.listing_link}")
+    # Все страницы объявлений отдает один origin: по HTTP/2 параллельные запросы идут
+    # потоками внутри одного TLS-соединения (с HPACK-сжатием повторяющихся заголовков).
+    # Пул соединений согласован с семафором: если сервер ответит по HTTP/1.1,
+    # каждому одновременному запросу хватит keep-alive соединения без очереди внутри httpx
+    # keepalive_expiry держит простаивающие соединения дольше паузы между волнами запросов
+    limits = httpx.Limits(
+        max_connections=concurrency * 2,
+        max_keepalive_connections=concurrency,
+        keepalive_expiry=30.0,
+    )
     
-    print(f"\nУспешно обработано: {len(parsed_listings)} из {len(listing_urls)}")
-    return parsed_listings
+    # Загрузка страниц идет в event loop, а разбор HTML - параллельно в общем пуле процессов
+    executor = _get_parse_pool()
+    transport = httpx.AsyncHTTPTransport(http2=True, limits=limits, retries=_CONNECT_RETRIES)
+    async with httpx.AsyncClient(
+        transport=transport,
+        timeout=httpx.Timeout(30.0, connect=10.0),
+        headers=LISTING_HEADERS,
+    ) as client:
+        # Фиксированный пул из concurrency воркеров, забирающих URL из очереди:
+        # одновременно существует O(concurrency) задач, а не по задаче на каждый URL
+        url_queue = asyncio.Queue()
+        for url in listing_urls:
+            url_queue.put_nowait(url)
+        # Ограниченная очередь результатов притормаживает воркеров, если потребитель не успевает
+        results = asyncio.Queue(maxsize=concurrency)
+        
+        async def worker():
+            while True:
+                try:
+                    url = url_queue.get_nowait()
+                except asyncio.QueueEmpty:
+                    return
+                try:
+                    result = await parse_listing(
+                        client, url, admission, executor, cache_dir, cache_ttl, fields=fields, limiter=limiter
+                    )
+                except Exception as e:
+                    logger.warning("Ошибка при обработке объявления %s: %s", url, e)
+                    result = None
+                await results.put(result)
+        
+        # watchdog и воркеры создаются внутри try: что бы ни упало, finally их отменит
+        watchdog = None
+        workers = []
+        try:
+            watchdog = asyncio.create_task(admission_watchdog(admission, max_limit=concurrency))
+            workers += [asyncio.create_task(worker()) for _ in range(min(concurrency, len(listing_urls)))]
+            for _ in range(len(listing_urls)):
+                result = await results.get()
+                if result:
+                    parsed_count += 1
+                    # Построчный вывод на каждое объявление - только в debug, итоги печатает __main__
+                    logger.debug("Обработано объявление %d/%d: %s", parsed_count, len(listing_urls), result.listing_link)
+                    yield result
+        finally:
+            if watchdog is not None:
+                watchdog.cancel()
+            for task in workers:
+                task.cancel()
+
+    print(f"\nУспешно обработано: {parsed_count} из {len(listing_urls)}")
 
 
-def parse_listings(listing_urls: list[str], concurrency: int = 10, limit: int = None) -> list[DbDTO]:
+async def parse_listings_async(
+    listing_urls: list[str],
+    concurrency: int = 10,
+    limit: int = None,
+    fields: frozenset[str] | None = None
+) -> list[DbDTO]:
+    """
+    Асинхронно парсит список объявлений
+    
+    Args:
+        listing_urls: Список URL объявлений
+        concurrency: Количество одновременных запросов
+        limit: Ограничение количества объявлений для обработки (опционально)
+        fields: Набор нужных полей DbDTO для частичного разбора (опционально)
+    
+    Returns:
+        list: Список DbDTO объектов с данными объявлений
+    """
+    return [dto async for dto in iter_listings_async(listing_urls, concurrency, limit, fields=fields)]
+
+
+class ListingsJsonWriter:
+    """
+    Пишет объявления в JSON-массив по одному, по мере поступления,
+    вместо того чтобы собирать все DbDTO в памяти и делать один json.dump в конце
+    """
+    
+    def __init__(self, file) -> None:
+        # file должен быть открыт в бинарном режиме ('wb')
+        self.file = file
+        self.count = 0
+        self.file.write(b'[')
+    
+    def write(self, dto: DbDTO) -> None:
+        self.file.write(b',\n' if self.count else b'\n')
+        # mode='json' сразу приводит даты и прочие типы к JSON-совместимым
+        self.file.write(_json_dumps(dto.model_dump(mode='json', exclude_none=True)))
+        self.count += 1
+    
+    def close(self) -> None:
+        self.file.write(b'\n]\n' if self.count else b']\n')
+
+
+async def save_listings_async(
+    listing_urls: list[str],
+    writer: ListingsJsonWriter,
+    concurrency: int = 10,
+    cache_dir: str | None = None,
+    fields: frozenset[str] | None = None,
+    rate_limit: float | None = None,
+    cache_ttl: float | None = 86400
+) -> int:
+    """
+    Парсит объявления и сразу записывает каждое в writer
+    
+    Args:
+        fields: Набор нужных полей DbDTO для частичного разбора (опционально, см. extract_listing_data)
+        rate_limit: Максимальная средняя частота запросов в секунду (опционально, см. iter_listings_async)
+        cache_ttl: Срок свежести копии в кеше в секундах (см. iter_listings_async)
+    
+    Returns:
+        int: Количество записанных объявлений
+    """
+    saved = 0
+    async for dto in iter_listings_async(
+        listing_urls, concurrency, cache_dir=cache_dir, fields=fields, rate_limit=rate_limit, cache_ttl=cache_ttl
+    ):
+        writer.write(dto)
+        saved += 1
+    return saved
+
+
+def parse_listings(
+    listing_urls: list[str],
+    concurrency: int = 10,
+    limit: int = None,
+    fields: frozenset[str] | None = None
+) -> list[DbDTO]:
     """
     Синхронная обертка для парсинга объявлений
     """
-    return asyncio.run(parse_listings_async(listing_urls, concurrency, limit))
+    return asyncio.run(parse_listings_async(listing_urls, concurrency, limit, fields))
+
+
+async def run_pipeline(
+    output_file: str,
+    links_file: str | None = None,
+    fields: frozenset[str] | None = None,
+    rate_limit: float | None = None
+) -> tuple[int, int]:
+    """
+    Весь конвейер в одном event loop: location URL из sitemap (process_sitemaps_async),
+    сбор ссылок на объявления для каждого location и парсинг объявлений
+    с записью в output_file по мере готовности
+    
+    Args:
+        output_file: JSON-файл для результатов
+        links_file: JSONL-файл для постраничной записи собранных ссылок (опционально)
+        fields: Набор нужных полей DbDTO для частичного разбора (опционально, по умолчанию - все)
+        rate_limit: Максимальная частота запросов страниц объявлений в секунду (опционально)
+    
+    Returns:
+        tuple: (количество обработанных location URL, количество записанных объявлений)
+    """
+    total_location_urls = 0
+    total_listings = 0
+    concurrency = 10
+    
+    # Один клиент поиска на все location'ы: TLS-соединение с compass открывается один раз
+    async with new_search_client(concurrency) as search_client:
+        with open(output_file, 'wb') as f:
+            writer = ListingsJsonWriter(f)
+            
+            # finally: даже при Ctrl+C или ошибке загрузки sitemap закрываем JSON-массив,
+            # чтобы уже записанные объявления оставались валидным файлом
+            try:
+                # Обрабатываем каждый location URL из sitemap постепенно
+                async for location_url in process_sitemaps_async():
+                    total_location_urls += 1
+                    print(f"\n{'='*60}")
+                    print(f"Обработка location URL {total_location_urls}: {location_url}")
+                    print(f"{'='*60}")
+
+                    try:
+                        # Собираем ссылки на объявления для данного location
+                        print(f"\nСбор ссылок на объявления из {location_url}...")
+                        links = await get_all_listing_links_async(
+                            location_url, concurrency=concurrency, links_file=links_file, client=search_client
+                        )
+                        print(f"Собрано ссылок: {len(links)}")
+
+                        if links:
+                            # Парсим объявления и сразу сохраняем их
+                            print(f"Парсинг объявлений...")
+                            saved = await save_listings_async(
+                                links, writer, concurrency=concurrency, fields=fields, rate_limit=rate_limit
+                            )
+                            total_listings += saved
+                            print(f"Добавлено объявлений: {saved}, всего: {total_listings}")
+                    except Exception as e:
+                        print(f"Ошибка при обработке {location_url}: {e}")
+                        continue
+            finally:
+                writer.close()
+    
+    return total_location_urls, total_listings
 
 
 # Пример использования
@@ -1148,45 +2102,15 @@ if __name__ == "__main__":
     print("ШАГ 1-2: Сбор ссылок и парсинг объявлений")
     print("=" * 60)
     
-    all_listings_data = []
-    total_location_urls = 0
-    
-    # Обрабатываем каждый location URL из sitemap постепенно
-    for location_url in process_sitemaps_generator():
-        total_location_urls += 1
-        print(f"\n{'='*60}")
-        print(f"Обработка location URL {total_location_urls}: {location_url}")
-        print(f"{'='*60}")
-        
-        try:
-            # Собираем ссылки на объявления для данного location
-            print(f"\nСбор ссылок на объявления из {location_url}...")
-            links = get_all_listing_links(location_url, concurrency=10)
-            print(f"Собрано ссылок: {len(links)}")
-            
-            if links:
-                # Парсим объявления
-                print(f"Парсинг объявлений...")
-                listings_data = parse_listings(links, concurrency=10)
-                all_listings_data.extend(listings_data)
-                print(f"Добавлено объявлений: {len(listings_data)}, всего: {len(all_listings_data)}")
-        except Exception as e:
-            print(f"Ошибка при обработке {location_url}: {e}")
-            continue
+    # Результаты пишутся в файл по мере парсинга, а не в конце
+    output_file = 'listings_data.json'
+    # Ссылки пишутся постранично по мере сбора - после падения видно, что уже собрано
+    links_file = 'listing_links.jsonl'
+    # Один event loop на весь запуск: загрузка sitemap идет параллельно со сбором ссылок и парсингом
+    total_location_urls, total_listings = asyncio.run(run_pipeline(output_file, links_file))
     
     print(f"\n{'='*60}")
     print(f"Обработано location URLs: {total_location_urls}")
-    print(f"Всего собрано объявлений: {len(all_listings_data)}")
-    
-    # Шаг 3: Сохраняем в JSON
-    print("\n" + "=" * 60)
-    print("ШАГ 3: Сохранение результатов")
-    print("=" * 60)
-    output_file = 'listings_data.json'
-    with open(output_file, 'w', encoding='utf-8') as f:
-        # Преобразуем DbDTO объекты в словари для JSON
-        listings_dict = [dto.model_dump(exclude_none=True) for dto in all_listings_data]
-        json.dump(listings_dict, f, ensure_ascii=False, indent=2, default=str)
-    
+    print(f"Всего собрано объявлений: {total_listings}")
     print(f"\n✓ Данные сохранены в файл '{output_file}'")
-    print(f"✓ Обработано объявлений: {len(all_listings_data)}")
\ No newline at end of file
+    print(f"✓ Обработано объявлений: {total_listings}")